@@ -0,0 +1,67 @@
+"""
+Wrap a data loader so that the host to device copy of the next batch
+runs on a side CUDA stream while the current batch is being processed.
+"""
+
+import torch
+
+
+class CudaPrefetcher:
+    """
+    Iterate over (input, label) batches of a loader already moved to the GPU.
+    Falls back to plain iteration over the loader when CUDA is not available.
+    The copies are only asynchronous for a loader with pin_memory=True.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = device
+        self.use_cuda = torch.cuda.is_available()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if not self.use_cuda:
+            for batch in self.loader:
+                yield batch
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        next_batch = self._preload(batches, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            # The batch is now consumed on the default stream
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._preload(batches, stream)
+            yield batch
+
+    def _preload(self, batches, stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return tuple(t.cuda(self.device, non_blocking=True) for t in batch)
+
+
+def collect_logits(loader, model):
+    """
+    Logits and labels of all the batches of a loader, copied into buffers sized for the whole sampler.
+    Half precision logits (e.g. from an autocast forward) are stored in float32.
+    """
+    num_samples = len(loader.sampler)
+    logits, labels = None, None
+    offset = 0
+    for input, label in CudaPrefetcher(loader):
+        batch_logits = model(input)
+        if logits is None:
+            logits = batch_logits.new_empty((num_samples,) + batch_logits.shape[1:],
+                                            dtype=torch.promote_types(batch_logits.dtype, torch.float32))
+            labels = label.new_empty((num_samples,))
+        logits[offset:offset + batch_logits.shape[0]].copy_(batch_logits)
+        labels[offset:offset + label.shape[0]].copy_(label)
+        offset += label.shape[0]
+    return logits[:offset].cuda(), labels[:offset].cuda()
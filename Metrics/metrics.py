@@ -39,19 +39,25 @@ def _populate_bins(confs, preds, labels, num_bins=10):
     for i in range(num_bins):
         bin_dict[i] = {}
     _bin_initializer(bin_dict, num_bins)
-    num_test_samples = len(confs)
-
-    for i in range(0, num_test_samples):
-        confidence = confs[i]
-        prediction = preds[i]
-        label = labels[i]
-        binn = int(math.ceil(((num_bins * confidence) - 1)))
-        bin_dict[binn][COUNT] = bin_dict[binn][COUNT] + 1
-        bin_dict[binn][CONF] = bin_dict[binn][CONF] + confidence
-        bin_dict[binn][ACC] = bin_dict[binn][ACC] + \
-            (1 if (label == prediction) else 0)
+    if torch.is_tensor(confs):
+        confs = confs.cpu().numpy()
+    if torch.is_tensor(preds):
+        preds = preds.cpu().numpy()
+    if torch.is_tensor(labels):
+        labels = labels.cpu().numpy()
+
+    # Accumulate all samples at once, sample i goes to bin ceil(num_bins * conf_i - 1)
+    confs = np.asarray(confs, dtype=np.float64)
+    correct = (np.asarray(preds) == np.asarray(labels)).astype(np.float64)
+    binns = np.ceil((num_bins * confs) - 1).astype(np.int64)
+    counts = np.bincount(binns, minlength=num_bins)
+    conf_sums = np.bincount(binns, weights=confs, minlength=num_bins)
+    acc_sums = np.bincount(binns, weights=correct, minlength=num_bins)
 
     for binn in range(0, num_bins):
+        bin_dict[binn][COUNT] = int(counts[binn])
+        bin_dict[binn][CONF] = float(conf_sums[binn])
+        bin_dict[binn][ACC] = int(acc_sums[binn])
         if (bin_dict[binn][COUNT] == 0):
             bin_dict[binn][BIN_ACC] = 0
             bin_dict[binn][BIN_CONF] = 0
@@ -119,12 +125,19 @@ def test_classification_net_logits(logits, labels):
     This function reports classification accuracy and confusion matrix given logits and labels
     from a model.
     '''
+    softmax = F.softmax(logits, dim=1)
+    confidence_vals, predictions = torch.max(softmax, dim=1)
+    return test_classification_net_probs(confidence_vals, predictions, labels)
+
+
+def test_classification_net_probs(confidence_vals, predictions, labels):
+    '''
+    test_classification_net_logits from already computed confidences and predictions.
+    '''
     labels_list = []
     predictions_list = []
     confidence_vals_list = []
 
-    softmax = F.softmax(logits, dim=1)
-    confidence_vals, predictions = torch.max(softmax, dim=1)
     labels_list.extend(labels.cpu().numpy().tolist())
     predictions_list.extend(predictions.cpu().numpy().tolist())
     confidence_vals_list.extend(confidence_vals.cpu().numpy().tolist())
@@ -133,6 +146,68 @@ def test_classification_net_logits(logits, labels):
         predictions_list, confidence_vals_list
 
 
+def softmax_stats(logits, labels, dtype=None):
+    '''
+    Softmax, log-softmax, confidences, predictions and accuracies of the logits, the softmax in dtype when given.
+    '''
+    log_softmaxes = F.log_softmax(logits, dim=1)
+    if dtype is None:
+        softmaxes = F.softmax(logits, dim=1)
+        confidences, predictions = torch.max(softmaxes, 1)
+    else:
+        softmaxes = F.softmax(logits.to(dtype), dim=1)
+        predictions = torch.argmax(logits, 1)
+        confidences = softmaxes.gather(1, predictions.unsqueeze(1)).squeeze(1).float()
+    accuracies = predictions.eq(labels)
+    return softmaxes, log_softmaxes, confidences, predictions, accuracies
+
+
+@torch.jit.script
+def scaled_softmax_max(logits, temperature):
+    '''
+    Top-class softmax confidences of logits / temperature (a single value or one per sample).
+    '''
+    if temperature.dim() == 1:
+        temperature = temperature.unsqueeze(1)
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    return 1.0 / torch.exp(shifted / temperature).sum(dim=1)
+
+
+@torch.jit.script
+def softmax_max(logits):
+    '''
+    Top-class softmax confidences of the logits.
+    '''
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    return 1.0 / torch.exp(shifted).sum(dim=1)
+
+
+@torch.jit.script
+def softmax_top(logits):
+    '''
+    Top-class softmax confidences and predictions of the logits.
+    '''
+    max_logits, predictions = torch.max(logits, 1, keepdim=True)
+    return 1.0 / torch.exp(logits - max_logits).sum(dim=1), predictions.squeeze(1)
+
+
+@torch.jit.script
+def candidates_softmax_max(shifted, temperatures):
+    '''
+    Top-class softmax confidences [K, N] of the max-shifted logits for each of K temperatures.
+    '''
+    return 1.0 / torch.exp(shifted.unsqueeze(0) / temperatures.view(-1, 1, 1)).sum(dim=2)
+
+
+@torch.jit.script
+def candidates_nll(shifted, label_logits, temperatures):
+    '''
+    Per-sample NLLs [K, N] of the max-shifted logits for each of K temperatures.
+    '''
+    return torch.log(torch.exp(shifted.unsqueeze(0) / temperatures.view(-1, 1, 1)).sum(dim=2)) \
+        - label_logits.unsqueeze(0) / temperatures.view(-1, 1)
+
+
 def test_classification_net(model, data_loader, device):
     '''
     This function reports classification accuracy and confusion matrix over a dataset.
@@ -159,6 +234,175 @@ def test_classification_net(model, data_loader, device):
         predictions_list, confidence_vals_list
 
 
+@torch.jit.script
+def bin_sums(confidences, accuracies, bin_boundaries):
+    '''
+    Per-bin confidence sums, accuracy sums and counts over (lower, upper] bins.
+    '''
+    n_bins = bin_boundaries.shape[0] - 1
+    bin_idx = torch.bucketize(confidences, bin_boundaries[1:-1].to(confidences.device))
+    count = torch.bincount(bin_idx, minlength=n_bins).float()
+    conf_sum = torch.bincount(bin_idx, weights=confidences.float(), minlength=n_bins)
+    acc_sum = torch.bincount(bin_idx, weights=accuracies.float(), minlength=n_bins)
+    return conf_sum, acc_sum, count
+
+
+@torch.jit.script
+def batched_bin_sums(confidences, accuracies, bin_boundaries):
+    '''
+    bin_sums for [K, N] confidences and accuracies, each sum of shape [K, n_bins].
+    '''
+    n_bins = bin_boundaries.shape[0] - 1
+    k = confidences.shape[0]
+    bin_idx = torch.bucketize(confidences, bin_boundaries[1:-1].to(confidences.device))
+    flat = (bin_idx + (torch.arange(k, device=confidences.device) * n_bins).unsqueeze(1)).reshape(-1)
+    count = torch.bincount(flat, minlength=k * n_bins).float()
+    conf_sum = torch.bincount(flat, weights=confidences.float().reshape(-1), minlength=k * n_bins)
+    acc_sum = torch.bincount(flat, weights=accuracies.float().reshape(-1), minlength=k * n_bins)
+    return conf_sum.view(k, n_bins), acc_sum.view(k, n_bins), count.view(k, n_bins)
+
+
+@torch.jit.script
+def batched_classwise_bin_sums(softmaxes, labels, bin_boundaries, num_classes: int):
+    '''
+    classwise_bin_sums for [K, N, C] softmaxes, each sum of shape [K, num_classes, n_bins].
+    '''
+    n_bins = bin_boundaries.shape[0] - 1
+    k = softmaxes.shape[0]
+    softmaxes = softmaxes[:, :, :num_classes].float()
+    bin_idx = torch.bucketize(softmaxes, bin_boundaries[1:-1].to(softmaxes.device))
+    offsets = torch.arange(k * num_classes, device=softmaxes.device).view(k, 1, num_classes) * n_bins
+    flat = (offsets + bin_idx).reshape(-1)
+    in_range = softmaxes.gt(bin_boundaries[0].to(softmaxes.device)).float()
+    labels_onehot = F.one_hot(labels, num_classes).float().unsqueeze(0)
+    size = k * num_classes * n_bins
+    count = torch.bincount(flat, weights=in_range.reshape(-1), minlength=size)
+    conf_sum = torch.bincount(flat, weights=(softmaxes * in_range).reshape(-1), minlength=size)
+    acc_sum = torch.bincount(flat, weights=(labels_onehot * in_range).reshape(-1), minlength=size)
+    return conf_sum.view(k, num_classes, n_bins), acc_sum.view(k, num_classes, n_bins), count.view(k, num_classes, n_bins)
+
+
+@torch.jit.script
+def classwise_bin_sums(softmaxes, labels, bin_boundaries, num_classes: int):
+    '''
+    Per-(class, bin) confidence sums, class indicator sums and counts, each [num_classes, n_bins].
+    '''
+    conf_sum, acc_sum, count = batched_classwise_bin_sums(softmaxes.unsqueeze(0), labels, bin_boundaries, num_classes)
+    return conf_sum[0], acc_sum[0], count[0]
+
+
+@torch.jit.script
+def label_bin_sums(confidences, accuracies, labels, bin_boundaries, num_classes: int):
+    '''
+    bin_sums over the samples of every label, each of shape [num_classes, n_bins].
+    '''
+    n_bins = bin_boundaries.shape[0] - 1
+    bin_idx = torch.bucketize(confidences, bin_boundaries[1:-1].to(confidences.device))
+    flat = labels * n_bins + bin_idx
+    size = num_classes * n_bins
+    count = torch.bincount(flat, minlength=size).float()
+    conf_sum = torch.bincount(flat, weights=confidences.float(), minlength=size)
+    acc_sum = torch.bincount(flat, weights=accuracies.float(), minlength=size)
+    return conf_sum.view(num_classes, n_bins), acc_sum.view(num_classes, n_bins), count.view(num_classes, n_bins)
+
+
+def posneg_bins_ece(conf_sum, acc_sum, count, totals, n_bins):
+    '''
+    Over- and under-confidence ECE of every bin summed over the classes, printing the per-bin statistics.
+    '''
+    non_empty = count.gt(0)
+    safe_count = count.clamp(min=1)
+    accuracy_in_bin = torch.where(non_empty, acc_sum / safe_count, torch.zeros_like(acc_sum))
+    avg_confidence_in_bin = torch.where(non_empty, conf_sum / safe_count, torch.zeros_like(conf_sum))
+    gap = avg_confidence_in_bin - accuracy_in_bin
+    prop_in_bin = count / totals.float().clamp(min=1).view(-1, 1)
+    over = non_empty & gap.gt(0)
+    under = non_empty & ~gap.gt(0)
+    ece_bins = torch.abs(gap) * prop_in_bin
+    over_ece_bins = torch.where(over, ece_bins, torch.zeros_like(ece_bins)).sum(dim=0)
+    under_ece_bins = torch.where(under, ece_bins, torch.zeros_like(ece_bins)).sum(dim=0)
+    lower_bin_acc = accuracy_in_bin[:, 0]
+    lower_bin_conf = avg_confidence_in_bin[:, 0]
+    upper_bin_acc = accuracy_in_bin[:, n_bins - 1]
+    upper_bin_conf = avg_confidence_in_bin[:, n_bins - 1]
+    counts_over = over.t().float().cpu()
+    counts_under = under.t().float().cpu()
+
+    print("Lowest bin average accuracy per class: ", lower_bin_acc.mean().item())
+    print("Lowest bin average confidence per class: ", lower_bin_conf.mean().item())
+    print("Lowest bin over confidences classes: ", lower_bin_acc.mean().item())
+    print("Lowest bin under confidences classes:: ", lower_bin_conf.mean().item())
+    print("Upper bin average accuracy per class: ", upper_bin_acc.mean().item())
+    print("Upper bin average confidence per class: ", upper_bin_conf.mean().item())
+    print("Bins average accuracies per class: ", accuracy_in_bin.t().mean(dim=1))
+    print("Bins average confidences per class: ", avg_confidence_in_bin.t().mean(dim=1))
+    print("Bins over confidences classes count: ", counts_over.sum(dim=1))
+    print("Bins under confidences classes count: ", counts_under.sum(dim=1))
+
+    return over_ece_bins, under_ece_bins
+
+
+def class_accuracies(predictions, labels, num_classes):
+    '''
+    Accuracy among the samples of each class, of length num_classes.
+    '''
+    class_correct = torch.bincount(labels, weights=predictions.eq(labels).float(), minlength=num_classes)
+    class_count = torch.bincount(labels, minlength=num_classes).float()
+    return class_correct[:num_classes] / class_count[:num_classes]
+
+
+@torch.jit.script
+def equal_mass_bin_edges(x, n_bins: int, is_sorted: bool = False):
+    '''
+    Edges of n_bins bins holding the same number of samples of x, as np.interp over the sorted samples.
+    '''
+    npt = x.shape[0]
+    sorted_x = x.reshape(-1).double() if is_sorted else torch.sort(x.reshape(-1))[0].double()
+    pos = torch.linspace(0, npt, n_bins + 1, dtype=torch.float64, device=x.device)
+    lo = pos.floor().long().clamp(max=npt - 1)
+    hi = (lo + 1).clamp(max=npt - 1)
+    frac = (pos - lo.double()).clamp(max=1.0)
+    edges = sorted_x[lo] + frac * (sorted_x[hi] - sorted_x[lo])
+    return edges.to(x.dtype)
+
+
+@torch.jit.script
+def ece_score(confidences, accuracies, bin_boundaries):
+    '''
+    ECE of the confidences and accuracies over (lower, upper] bins.
+    '''
+    conf_sum, acc_sum, _ = bin_sums(confidences, accuracies, bin_boundaries)
+    return (torch.abs(conf_sum - acc_sum).sum() / confidences.shape[0]).view(1)
+
+
+@torch.jit.script
+def top_ece(logits, labels, bin_boundaries):
+    '''
+    ECE of the top-class softmax of the logits.
+    '''
+    confidences, predictions = softmax_top(logits)
+    return ece_score(confidences, predictions.eq(labels), bin_boundaries)
+
+
+@torch.jit.script
+def scaled_ece(logits, temperatures, labels, bin_boundaries):
+    '''
+    ECE of logits / temperatures (a single value or one per class).
+    '''
+    return top_ece(logits / temperatures, labels, bin_boundaries)
+
+
+def nll_ece(logits, labels, bin_boundaries):
+    '''
+    NLL and ECE of the logits, both of shape [1].
+    '''
+    log_softmaxes = F.log_softmax(logits, dim=1)
+    top_log_softmaxes, predictions = torch.max(log_softmaxes, 1)
+    nll = F.nll_loss(log_softmaxes, labels).view(1)
+    ece = ece_score(torch.exp(top_log_softmaxes), predictions.eq(labels), bin_boundaries)
+    return nll, ece
+
+
 # Calibration error scores in the form of loss metrics
 class ECELoss(nn.Module):
     '''
@@ -166,35 +410,19 @@ class ECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(ECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        # A buffer, so that .cuda() moves the boundaries once instead of every call copying them to the device
+        self.register_buffer('bin_boundaries', torch.linspace(0, 1, n_bins + 1))
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
         self.n_bins = n_bins
 
     def forward(self, logits, labels):
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
-        accuracies = predictions.eq(labels)
-        #counts_over = 0
-        #counts_under = 0
-
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                #if accuracy_in_bin < avg_confidence_in_bin:
-                    #counts_over += 1
-                #else:
-                    #counts_under += 1
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-        
-        #print('ECE count of over-confidences bins: ', counts_over)
-        #print('ECE count of under-confidences bins: ', counts_under)
-                
+        # Only the top class is binned, so the full softmax is never materialized
+        return top_ece(logits, labels, self.bin_boundaries)
+
+    def forward_from_probs(self, softmaxes, confidences, predictions, accuracies, labels):
+        ece = ece_score(confidences, accuracies, self.bin_boundaries)
+
         return ece
 
 
@@ -206,28 +434,19 @@ class AdaptiveECELoss(nn.Module):
         super(AdaptiveECELoss, self).__init__()
         self.nbins = n_bins
 
-    def histedges_equalN(self, x):
-        npt = len(x)
-        return np.interp(np.linspace(0, npt, self.nbins + 1),
-                     np.arange(npt),
-                     np.sort(x))
     def forward(self, logits, labels):
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
+        confidences, predictions = softmax_top(logits)
         accuracies = predictions.eq(labels)
-        n, bin_boundaries = np.histogram(confidences.cpu().detach(), self.histedges_equalN(confidences.cpu().detach()))
-        #print(n,confidences,bin_boundaries)
+        return self.forward_from_probs(None, confidences, predictions, accuracies, labels)
+
+    def forward_from_probs(self, softmaxes, confidences, predictions, accuracies, labels):
+        bin_boundaries = equal_mass_bin_edges(confidences.detach(), self.nbins)
         self.bin_lowers = bin_boundaries[:-1]
         self.bin_uppers = bin_boundaries[1:]
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
+        # the lowest confidence sits on the first edge and, as with (lower, upper] bins, falls in no bin
+        in_range = confidences.gt(bin_boundaries[0])
+        conf_sum, acc_sum, _ = bin_sums(confidences[in_range], accuracies[in_range], bin_boundaries)
+        ece = (torch.abs(conf_sum - acc_sum).sum() / confidences.shape[0]).view(1)
         return ece
 
 
@@ -237,32 +456,21 @@ class ClasswiseECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(ClasswiseECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
-        num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
-        per_class_sce = None
-
-        for i in range(num_classes):
-            class_confidences = softmaxes[:, i]
-            class_sce = torch.zeros(1, device=logits.device)
-            labels_in_class = labels.eq(i) # one-hot vector of all positions where the label belongs to the class i
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = labels_in_class[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    class_sce += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce = class_sce
-            else:
-                per_class_sce = torch.cat((per_class_sce, class_sce), dim=0)
+        confidences, predictions = torch.max(softmaxes, 1)
+        accuracies = predictions.eq(labels)
+        return self.forward_from_probs(softmaxes, confidences, predictions, accuracies, labels)
+
+    def forward_from_probs(self, softmaxes, confidences, predictions, accuracies, labels):
+        num_classes = int((torch.max(labels) + 1).item())
+        # all (class, bin) pairs in one scatter, empty bins contribute nothing
+        conf_sum, acc_sum, _ = classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        per_class_sce = torch.abs(conf_sum - acc_sum).sum(dim=1) / softmaxes.shape[0]
 
         sce = torch.mean(per_class_sce)
         return sce
@@ -274,41 +482,35 @@ class ClassECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(ClassECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
-        num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
-        per_class_sce = None
-        choices = torch.argmax(softmaxes, dim=1)
-        classes_acc = []
-
-        for i in range(num_classes):
-            class_confidences = softmaxes[:, i]
-            class_choices = choices[labels.eq(i)]
-            class_choices = torch.sum(class_choices.eq(i)).item()
-            class_accuracy = class_choices / torch.sum(labels.eq(i)).item()
-            class_sce = torch.zeros(1, device=logits.device)
-            labels_in_class = labels.eq(i) # one-hot vector of all positions where the label belongs to the class i
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = labels_in_class[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    class_sce += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce = class_sce
-            else:
-                per_class_sce = torch.cat((per_class_sce, class_sce), dim=0)
-            
-            classes_acc.append(class_accuracy)
+        confidences, predictions = torch.max(softmaxes, 1)
+        accuracies = predictions.eq(labels)
+        return self.forward_from_probs(softmaxes, confidences, predictions, accuracies, labels)
+
+    def forward_from_probs(self, softmaxes, confidences, predictions, accuracies, labels):
+        num_classes = int((torch.max(labels) + 1).item())
+        conf_sum, acc_sum, _ = classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        per_class_sce = torch.abs(conf_sum - acc_sum).sum(dim=1) / softmaxes.shape[0]
+
+        classes_acc = class_accuracies(predictions, labels, num_classes)
 
         return per_class_sce, classes_acc
+
+    def forward_stacked(self, softmaxes, labels):
+        '''
+        Per-class ECE and accuracies, both [K, C], of K stacked [K, N, C] softmax outputs.
+        '''
+        num_classes = int((torch.max(labels) + 1).item())
+        conf_sum, acc_sum, _ = batched_classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        per_class_sce = torch.abs(conf_sum - acc_sum).sum(dim=2) / softmaxes.shape[1]
+        _, predictions = torch.max(softmaxes, 2)
+        classes_acc = torch.stack([class_accuracies(p, labels, num_classes) for p in predictions])
+        return per_class_sce, classes_acc
     
     
 class ClassECELoss2(nn.Module):
@@ -317,99 +519,60 @@ class ClassECELoss2(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(ClassECELoss2, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
         confidences, choices = torch.max(softmaxes, 1)
-        per_class_sce = None
-        classes_acc = []
-
-        for i in range(num_classes):
-            class_confidences = confidences[labels == i]
-            accuracies_i = choices[labels == i].eq(i)
-            class_accuracy = torch.sum(accuracies_i).item() / torch.sum(labels.eq(i)).item()
-            class_sce = torch.zeros(1, device=logits.device)
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = accuracies_i[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    class_sce += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce = class_sce
-            else:
-                per_class_sce = torch.cat((per_class_sce, class_sce), dim=0)
-            
-            classes_acc.append(class_accuracy)
 
+        # the bins of all classes from one bucketize, a class with no samples has no error
+        conf_sum, acc_sum, _ = label_bin_sums(confidences, choices.eq(labels), labels, self.bin_boundaries, num_classes)
+        class_count = torch.bincount(labels, minlength=num_classes).float().clamp(min=1)
+        per_class_sce = torch.abs(conf_sum - acc_sum).sum(dim=1) / class_count
+
+        classes_acc = class_accuracies(choices, labels, num_classes)
         return per_class_sce, classes_acc
     
+
 class posnegECELoss2(nn.Module):
     '''
     Compute per-Class powsitiv and negative ECE
     '''
     def __init__(self, n_bins=15):
         super(posnegECELoss2, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
         confidences, choices = torch.max(softmaxes, 1)
-        classes_acc = []
-        
-        counts_over = torch.zeros(num_classes)
-        counts_under = torch.zeros(num_classes)
-        bins_over = []
-        bins_under = []
-
-        for i in range(num_classes):
-            class_confidences = confidences[labels == i]
-            accuracies_i = choices[labels == i].eq(i)
-            class_accuracy = torch.sum(accuracies_i).item() / torch.sum(labels.eq(i)).item()
-            class_sce_pos = torch.zeros(1, device=logits.device)
-            class_sce_neg = torch.zeros(1, device=logits.device)
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = accuracies_i[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    if avg_confidence_in_bin - accuracy_in_bin > 0:
-                        bins_over.append(bin_lower)
-                        counts_over[i] += 1 
-                        class_sce_pos += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                    else:
-                        bins_under.append(bin_lower)
-                        counts_under[i] += 1
-                        class_sce_neg += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce_pos = class_sce_pos
-                per_class_sce_neg = class_sce_neg
-            else:
-                per_class_sce_pos = torch.cat((per_class_sce_pos, class_sce_pos), dim=0)
-                per_class_sce_neg = torch.cat((per_class_sce_neg, class_sce_neg), dim=0)
-                
-            classes_acc.append(class_accuracy)
+
+        # all (class, bin) pairs at once, split by the sign of avg_confidence - accuracy
+        conf_sum, acc_sum, count = label_bin_sums(confidences, choices.eq(labels), labels, self.bin_boundaries, num_classes)
+        class_count = torch.bincount(labels, minlength=num_classes).float().clamp(min=1)
+        non_empty = count.gt(0)
+        gap = conf_sum - acc_sum
+        over = non_empty * gap.gt(0)
+        under = non_empty * ~gap.gt(0)
+        per_class_sce_pos = (torch.abs(gap) * over).sum(dim=1) / class_count
+        per_class_sce_neg = (torch.abs(gap) * under).sum(dim=1) / class_count
+
+        bin_lowers = self.bin_lowers.to(logits.device).unsqueeze(0)
         print('total samples number: ', labels.shape[0])
-        print('over confidence counts sum: ', torch.sum(counts_over).item())
-        print('under confidence counts sum: ', torch.sum(counts_under).item())
-        print('over confidence bins: ', torch.mean(torch.FloatTensor(bins_over)).item())
-        print('under confidence bins: ', torch.mean(torch.FloatTensor(bins_under)).item())
+        print('over confidence counts sum: ', torch.sum(over.float()).item())
+        print('under confidence counts sum: ', torch.sum(under.float()).item())
+        print('over confidence bins: ', ((bin_lowers * over).sum() / over.sum()).item())
+        print('under confidence bins: ', ((bin_lowers * under).sum() / under.sum()).item())
 
+        classes_acc = class_accuracies(choices, labels, num_classes)
         return per_class_sce_pos, per_class_sce_neg, classes_acc
     
+
 # Calibration error scores in the form of loss metrics
 class posnegECEbinsLoss2(nn.Module):
     '''
@@ -417,75 +580,25 @@ class posnegECEbinsLoss2(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(posnegECEbinsLoss2, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
         self.n_bins = n_bins
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
         confidences, choices = torch.max(softmaxes, 1)
-        
-        counts_over = torch.zeros((self.n_bins, num_classes))
-        counts_under = torch.zeros((self.n_bins, num_classes))
-        bins_over = []
-        bins_under = []
-        over_ece_bins = torch.zeros(self.bin_lowers.shape, device=logits.device)
-        under_ece_bins = torch.zeros(self.bin_lowers.shape, device=logits.device)
-        lower_bin_acc = torch.zeros(num_classes, device=logits.device)
-        lower_bin_conf = torch.zeros(num_classes, device=logits.device)
-        upper_bin_acc = torch.zeros(num_classes, device=logits.device)
-        upper_bin_conf = torch.zeros(num_classes, device=logits.device)
-        mid_bins_acc = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        mid_bins_conf = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        
-        for i in range(num_classes):
-            class_confidences = confidences[labels == i]
-            accuracies_i = choices[labels == i].eq(i)
-            bin = 0
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = accuracies_i[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    
-                    if bin_lower == 0:
-                        lower_bin_acc[i] += accuracy_in_bin
-                        lower_bin_conf[i] += avg_confidence_in_bin
-                    if bin_upper == 1:
-                        upper_bin_acc[i] += accuracy_in_bin
-                        upper_bin_conf[i] += avg_confidence_in_bin
-                    #if bin_lower == self.bin_lowers[int(self.n_bins / 2)]:
-                    mid_bins_acc[bin, i] += accuracy_in_bin
-                    mid_bins_conf[bin, i] += avg_confidence_in_bin
-                        
-                    if avg_confidence_in_bin - accuracy_in_bin > 0:
-                        over_ece_bins[bin] += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                        bins_over.append(bin_lower)
-                        counts_over[bin, i] += 1 
-                    else:
-                        under_ece_bins[bin] += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                        bins_under.append(bin_lower)
-                        counts_under[bin, i] += 1
-                bin += 1
-                
-        print("Lowest bin average accuracy per class: ", lower_bin_acc.mean().item())
-        print("Lowest bin average confidence per class: ", lower_bin_conf.mean().item())
-        print("Lowest bin over confidences classes: ", lower_bin_acc.mean().item())
-        print("Lowest bin under confidences classes:: ", lower_bin_conf.mean().item())
-        print("Upper bin average accuracy per class: ", upper_bin_acc.mean().item())
-        print("Upper bin average confidence per class: ", upper_bin_conf.mean().item())
-        print("Bins average accuracies per class: ", mid_bins_acc.mean(dim=1))
-        print("Bins average confidences per class: ", mid_bins_conf.mean(dim=1))
-        print("Bins over confidences classes count: ", counts_over.sum(dim=1))
-        print("Bins under confidences classes count: ", counts_under.sum(dim=1))
+
+        # the confidences of every class's samples in its (class, bin) pairs, from one bucketize
+        conf_sum, acc_sum, count = label_bin_sums(confidences, choices.eq(labels), labels, self.bin_boundaries, num_classes)
+        class_count = torch.bincount(labels, minlength=num_classes)
+        over_ece_bins, under_ece_bins = posneg_bins_ece(conf_sum, acc_sum, count, class_count, self.n_bins)
                               
         return over_ece_bins, under_ece_bins, self.bin_lowers
     
     
+
 # Calibration error scores in the form of loss metrics
 class posnegECELoss(nn.Module):
     '''
@@ -493,60 +606,32 @@ class posnegECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(posnegECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
-        per_class_sce = None
         choices = torch.argmax(softmaxes, dim=1)
-        classes_acc = []
-        
-        counts_over = torch.zeros(num_classes)
-        counts_under = torch.zeros(num_classes)
-        bins_over = []
-        bins_under = []
-
-        for i in range(num_classes):
-            class_confidences = softmaxes[:, i]
-            class_choices = choices[labels.eq(i)]
-            class_choices = torch.sum(class_choices.eq(i)).item()
-            class_accuracy = class_choices / torch.sum(labels.eq(i)).item()
-            class_sce_pos = torch.zeros(1, device=logits.device)
-            class_sce_neg = torch.zeros(1, device=logits.device)
-            labels_in_class = labels.eq(i) # one-hot vector of all positions where the label belongs to the class i
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = labels_in_class[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    if avg_confidence_in_bin - accuracy_in_bin > 0:
-                        bins_over.append(bin_lower)
-                        counts_over[i] += 1 
-                        class_sce_pos += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                    else:
-                        bins_under.append(bin_lower)
-                        counts_under[i] += 1
-                        class_sce_neg += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce_pos = class_sce_pos
-                per_class_sce_neg = class_sce_neg
-            else:
-                per_class_sce_pos = torch.cat((per_class_sce_pos, class_sce_pos), dim=0)
-                per_class_sce_neg = torch.cat((per_class_sce_neg, class_sce_neg), dim=0)
-                
-            classes_acc.append(class_accuracy)
+
+        # all (class, bin) pairs at once, split by the sign of avg_confidence - accuracy
+        conf_sum, acc_sum, count = classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        non_empty = count.gt(0)
+        gap = conf_sum - acc_sum
+        over = non_empty * gap.gt(0)
+        under = non_empty * ~gap.gt(0)
+        per_class_sce_pos = (torch.abs(gap) * over).sum(dim=1) / labels.shape[0]
+        per_class_sce_neg = (torch.abs(gap) * under).sum(dim=1) / labels.shape[0]
+
+        bin_lowers = self.bin_lowers.to(logits.device).unsqueeze(0)
         print('total samples number: ', labels.shape[0])
-        print('over confidence counts sum: ', torch.sum(counts_over).item())
-        print('under confidence counts sum: ', torch.sum(counts_under).item())
-        print('over confidence bins: ', torch.mean(torch.FloatTensor(bins_over)).item())
-        print('under confidence bins: ', torch.mean(torch.FloatTensor(bins_under)).item())
+        print('over confidence counts sum: ', torch.sum(over.float()).item())
+        print('under confidence counts sum: ', torch.sum(under.float()).item())
+        print('over confidence bins: ', ((bin_lowers * over).sum() / over.sum()).item())
+        print('under confidence bins: ', ((bin_lowers * under).sum() / under.sum()).item())
 
+        classes_acc = class_accuracies(choices, labels, num_classes)
         return per_class_sce_pos, per_class_sce_neg, classes_acc
     
     
@@ -557,61 +642,33 @@ class binsECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15, low_high_bin=0.3):
         super(binsECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
         self.low_high_bin = low_high_bin
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
-        per_class_sce = None
         choices = torch.argmax(softmaxes, dim=1)
-        classes_acc = []
-        
-        counts_high = torch.zeros(num_classes)
-        counts_low = torch.zeros(num_classes)
-        high_bins = []
-        low_bins = []
-
-        for i in range(num_classes):
-            class_confidences = softmaxes[:, i]
-            class_choices = choices[labels.eq(i)]
-            class_choices = torch.sum(class_choices.eq(i)).item()
-            class_accuracy = class_choices / torch.sum(labels.eq(i)).item()
-            class_sce_high = torch.zeros(1, device=logits.device)
-            class_sce_low = torch.zeros(1, device=logits.device)
-            labels_in_class = labels.eq(i) # one-hot vector of all positions where the label belongs to the class i
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = labels_in_class[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    if bin_lower > self.low_high_bin:
-                        high_bins.append(bin_lower)
-                        counts_high[i] += 1 
-                        class_sce_high += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                    else:
-                        low_bins.append(bin_lower)
-                        counts_low[i] += 1
-                        class_sce_low += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-            if (i == 0):
-                per_class_sce_high = class_sce_high
-                per_class_sce_low = class_sce_low
-            else:
-                per_class_sce_high = torch.cat((per_class_sce_high, class_sce_high), dim=0)
-                per_class_sce_low = torch.cat((per_class_sce_low, class_sce_low), dim=0)
-                
-            classes_acc.append(class_accuracy)
+
+        # all (class, bin) pairs at once, split by whether the bin starts above low_high_bin
+        conf_sum, acc_sum, count = classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        non_empty = count.gt(0)
+        bin_lowers = self.bin_lowers.to(logits.device).unsqueeze(0)
+        high = non_empty * bin_lowers.gt(self.low_high_bin)
+        low = non_empty * ~bin_lowers.gt(self.low_high_bin)
+        ece_bins = torch.abs(conf_sum - acc_sum)
+        per_class_sce_high = (ece_bins * high).sum(dim=1) / labels.shape[0]
+        per_class_sce_low = (ece_bins * low).sum(dim=1) / labels.shape[0]
+
         print('total samples number: ', labels.shape[0])
-        print('high bins counts sum: ', torch.sum(counts_high).item())
-        print('low bins counts sum: ', torch.sum(counts_low).item())
-        print('high bins: ', torch.mean(torch.FloatTensor(high_bins)).item())
-        print('low bins: ', torch.mean(torch.FloatTensor(low_bins)).item())
+        print('high bins counts sum: ', torch.sum(high.float()).item())
+        print('low bins counts sum: ', torch.sum(low.float()).item())
+        print('high bins: ', ((bin_lowers * high).sum() / high.sum()).item())
+        print('low bins: ', ((bin_lowers * low).sum() / low.sum()).item())
 
+        classes_acc = class_accuracies(choices, labels, num_classes)
         return per_class_sce_high, per_class_sce_low, classes_acc
     
 # Calibration error scores in the form of loss metrics
@@ -621,31 +678,26 @@ class diffECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(diffECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
         softmaxes = F.softmax(logits, dim=1)
         confidences, predictions = torch.max(softmaxes, 1)
         accuracies = predictions.eq(labels)
-        bin_over_confidence = []
-        bins = []
-
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                bin_over_confidence.append(((avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin).item())
-                bins.append(bin_lower.item())
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
+
+        # Calculated (confidence - accuracy) * prop_in_bin of every non-empty bin from one bucketize
+        conf_sum, acc_sum, count = bin_sums(confidences, accuracies, self.bin_boundaries)
+        gaps = (conf_sum - acc_sum) / confidences.shape[0]
+        ece = torch.abs(gaps).sum().view(1)
+        non_empty = count.gt(0).tolist()
+        bin_over_confidence = [gap for gap, full in zip(gaps.tolist(), non_empty) if full]
+        bins = [bin_lower for bin_lower, full in zip(self.bin_lowers.tolist(), non_empty) if full]
 
         return ece, bin_over_confidence, bins
     
+
 # Calibration error scores in the form of loss metrics
 class estECELoss(nn.Module):
     '''
@@ -653,9 +705,9 @@ class estECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(estECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
 
     def forward(self, logits, labels):
         softmaxes = F.softmax(logits, dim=1)
@@ -663,18 +715,11 @@ class estECELoss(nn.Module):
         accuracies = torch.gather(softmaxes, 1, labels.view(-1,1)).squeeze()
         #accuracies = predictions.eq(labels)
 
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
+        ece = ece_score(confidences, accuracies, self.bin_boundaries)
 
         return ece
     
+
 # Calibration error scores in the form of loss metrics
 class posnegECEbinsLoss(nn.Module):
     '''
@@ -682,77 +727,26 @@ class posnegECEbinsLoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(posnegECEbinsLoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
         self.n_bins = n_bins
 
     def forward(self, logits, labels):
         num_classes = int((torch.max(labels) + 1).item())
         softmaxes = F.softmax(logits, dim=1)
-        per_class_sce = None
-        
-        counts_over = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        counts_under = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        bins_over = []
-        bins_under = []
-        over_ece_bins = torch.zeros(self.bin_lowers.shape, device=logits.device)
-        under_ece_bins = torch.zeros(self.bin_lowers.shape, device=logits.device)
-        lower_bin_acc = torch.zeros(num_classes, device=logits.device)
-        lower_bin_conf = torch.zeros(num_classes, device=logits.device)
-        upper_bin_acc = torch.zeros(num_classes, device=logits.device)
-        upper_bin_conf = torch.zeros(num_classes, device=logits.device)
-        mid_bins_acc = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        mid_bins_conf = torch.zeros((self.n_bins, num_classes), device=logits.device)
-        
-        for i in range(num_classes):
-            class_confidences = softmaxes[:, i]
-            labels_in_class = labels.eq(i) # one-hot vector of all positions where the label belongs to the class i
-            bin = 0
-
-            for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-                in_bin = class_confidences.gt(bin_lower.item()) * class_confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if prop_in_bin.item() > 0:
-                    accuracy_in_bin = labels_in_class[in_bin].float().mean()
-                    avg_confidence_in_bin = class_confidences[in_bin].mean()
-                    
-                    if bin_lower == 0:
-                        lower_bin_acc[i] += accuracy_in_bin
-                        lower_bin_conf[i] += avg_confidence_in_bin
-                    if bin_upper == 1:
-                        upper_bin_acc[i] += accuracy_in_bin
-                        upper_bin_conf[i] += avg_confidence_in_bin
-                    #if bin_lower == self.bin_lowers[int(self.n_bins / 2)]:
-                    mid_bins_acc[bin, i] += accuracy_in_bin
-                    mid_bins_conf[bin, i] += avg_confidence_in_bin
-                        
-                    if avg_confidence_in_bin - accuracy_in_bin > 0:
-                        over_ece_bins[bin] += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                        bins_over.append(bin_lower)
-                        counts_over[bin, i] += 1 
-                    else:
-                        under_ece_bins[bin] += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-                        bins_under.append(bin_lower)
-                        counts_under[bin, i] += 1
-                bin += 1
-                
-        print("Lowest bin average accuracy per class: ", lower_bin_acc.mean().item())
-        print("Lowest bin average confidence per class: ", lower_bin_conf.mean().item())
-        print("Lowest bin over confidences classes: ", lower_bin_acc.mean().item())
-        print("Lowest bin under confidences classes:: ", lower_bin_conf.mean().item())
-        print("Upper bin average accuracy per class: ", upper_bin_acc.mean().item())
-        print("Upper bin average confidence per class: ", upper_bin_conf.mean().item())
-        print("Bins average accuracies per class: ", mid_bins_acc.mean(dim=1))
-        print("Bins average confidences per class: ", mid_bins_conf.mean(dim=1))
-        print("Bins over confidences classes count: ", counts_over.sum(dim=1))
-        print("Bins under confidences classes count: ", counts_under.sum(dim=1))
+
+        # the class confidences of all samples in every (class, bin) pair, from one bucketize
+        conf_sum, acc_sum, count = classwise_bin_sums(softmaxes, labels, self.bin_boundaries, num_classes)
+        totals = torch.full((num_classes,), labels.shape[0], device=logits.device)
+        over_ece_bins, under_ece_bins = posneg_bins_ece(conf_sum, acc_sum, count, totals, self.n_bins)
                               
         #over_ece_bins /= counts_over.sum(dim=1)
         #under_ece_bins /= counts_under.sum(dim=1)
         
         return over_ece_bins, under_ece_bins, self.bin_lowers
 
+
 # Calibration error scores in the form of loss metrics with explicit confidence
 class ConfECELoss(nn.Module):
     '''
@@ -760,9 +754,9 @@ class ConfECELoss(nn.Module):
     '''
     def __init__(self, n_bins=15):
         super(ConfECELoss, self).__init__()
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        self.bin_lowers = bin_boundaries[:-1]
-        self.bin_uppers = bin_boundaries[1:]
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1)
+        self.bin_lowers = self.bin_boundaries[:-1]
+        self.bin_uppers = self.bin_boundaries[1:]
         self.n_bins = n_bins
 
     def forward(self, logits, labels):
@@ -770,14 +764,6 @@ class ConfECELoss(nn.Module):
         confidences, predictions = torch.max(softmaxes, 1)
         accuracies = predictions.eq(labels)
 
-        ece = torch.zeros(1, device=logits.device)
-        for bin_lower, bin_upper in zip(self.bin_lowers, self.bin_uppers):
-            # Calculated |confidence - accuracy| in each bin
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            prop_in_bin = in_bin.float().mean()
-            if prop_in_bin.item() > 0:
-                accuracy_in_bin = accuracies[in_bin].float().mean()
-                avg_confidence_in_bin = confidences[in_bin].mean()
-                ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
+        ece = ece_score(confidences, accuracies, self.bin_boundaries)
                 
-        return ece
\ No newline at end of file
+        return ece
@@ -12,53 +12,9 @@ import numpy as np
 import os
 import torch
 from scipy.interpolate import make_interp_spline
+from Metrics.metrics import _populate_bins, COUNT, BIN_ACC, BIN_CONF
 plt.rcParams.update({'font.size': 20})
 
-# Some keys used for the following dictionaries
-COUNT = 'count'
-CONF = 'conf'
-ACC = 'acc'
-BIN_ACC = 'bin_acc'
-BIN_CONF = 'bin_conf'
-
-
-def _bin_initializer(bin_dict, num_bins=10):
-    for i in range(num_bins):
-        bin_dict[i][COUNT] = 0
-        bin_dict[i][CONF] = 0
-        bin_dict[i][ACC] = 0
-        bin_dict[i][BIN_ACC] = 0
-        bin_dict[i][BIN_CONF] = 0
-
-
-def _populate_bins(confs, preds, labels, num_bins=10):
-    bin_dict = {}
-    for i in range(num_bins):
-        bin_dict[i] = {}
-    _bin_initializer(bin_dict, num_bins)
-    num_test_samples = len(confs)
-
-    for i in range(0, num_test_samples):
-        confidence = confs[i]
-        prediction = preds[i]
-        label = labels[i]
-        binn = int(math.ceil(((num_bins * confidence) - 1)))
-        bin_dict[binn][COUNT] = bin_dict[binn][COUNT] + 1
-        bin_dict[binn][CONF] = bin_dict[binn][CONF] + confidence
-        bin_dict[binn][ACC] = bin_dict[binn][ACC] + \
-            (1 if (label == prediction) else 0)
-
-    for binn in range(0, num_bins):
-        if (bin_dict[binn][COUNT] == 0):
-            bin_dict[binn][BIN_ACC] = 0
-            bin_dict[binn][BIN_CONF] = 0
-        else:
-            bin_dict[binn][BIN_ACC] = float(
-                bin_dict[binn][ACC]) / bin_dict[binn][COUNT]
-            bin_dict[binn][BIN_CONF] = bin_dict[binn][CONF] / \
-                float(bin_dict[binn][COUNT])
-    return bin_dict
-
 
 def reliability_plot(confs, preds, labels, save_plots_loc, dataset, model, trained_loss, num_bins=15, scaling_related='before', save=False):
     '''
@@ -123,7 +79,7 @@ def pos_neg_ece_bins_plot(bins_vec, bins_ece_over, bins_ece_under, bins_ece_over
 
 def pos_neg_ece_plot(acc, csece_pos, csece_neg, save_plots_loc, dataset, model, trained_loss, acc_check=False, scaling_related='before', const_temp=False):
     plt.figure(figsize=(10, 8))
-    plt.scatter(acc, csece_pos.cpu(), s=70)
+    plt.scatter(acc.cpu(), csece_pos.cpu(), s=70)
     plt.xlabel('accuracy', fontsize=26)
     plt.xticks(fontsize=18)
     plt.ylabel('ECE', fontsize=26)
@@ -138,7 +94,7 @@ def pos_neg_ece_plot(acc, csece_pos, csece_neg, save_plots_loc, dataset, model,
     plt.close()
 
     plt.figure(figsize=(10, 8))
-    plt.scatter(acc, csece_neg.cpu(), s=70)
+    plt.scatter(acc.cpu(), csece_neg.cpu(), s=70)
     plt.xlabel('accuracy', fontsize=26)
     plt.xticks(fontsize=18)
     plt.ylabel('ECE', fontsize=26)
@@ -154,7 +110,7 @@ def pos_neg_ece_plot(acc, csece_pos, csece_neg, save_plots_loc, dataset, model,
     
 def ece_acc_plot(acc, csece, save_plots_loc, dataset, model, trained_loss, acc_check=False, scaling_related='before', const_temp=False, unc=False):
     plt.figure(figsize=(10, 8))
-    plt.scatter(acc, csece.cpu(), s=70)
+    plt.scatter(acc.cpu(), csece.cpu(), s=70)
     plt.xlabel('accuracy', fontsize=26)
     plt.xticks(fontsize=18)
     plt.ylabel('ECE', fontsize=26)
@@ -192,8 +148,8 @@ def ece_iters_plot(scaled_model, save_plots_loc, dataset, model, trained_loss, i
     
 def temp_acc_plot(acc, temp, single_temp, save_plots_loc, dataset, model, trained_loss, acc_check=False, const_temp=False):
     plt.figure()
-    plt.scatter(acc, temp.cpu(), label='Class-based temperature')
-    plt.plot(acc, single_temp*torch.ones(len(acc)), color='red', label='Single temperature')
+    plt.scatter(acc.cpu(), temp.cpu(), label='Class-based temperature')
+    plt.plot(acc.cpu(), single_temp*torch.ones(len(acc)), color='red', label='Single temperature')
     plt.xlabel('accuracy', fontsize=10)
     plt.xticks(fontsize=10)
     plt.ylabel('Temperature', fontsize=10)
@@ -210,7 +166,7 @@ def temp_acc_plot(acc, temp, single_temp, save_plots_loc, dataset, model, traine
 
 def diff_ece_plot(acc, csece1, csece2, save_plots_loc, dataset, model, trained_loss, acc_check=False, scaling_type='class_based'):
     plt.figure()
-    plt.scatter(acc, (csece1 - csece2).cpu())
+    plt.scatter(acc.cpu(), (csece1 - csece2).cpu())
     plt.xlabel('accuracy', fontsize=10)
     plt.xticks(fontsize=10)
     plt.ylabel('ECE difference', fontsize=10)
@@ -4,6 +4,7 @@ import torch
 import random
 import argparse
 from torch import nn
+from torch.nn import functional as F
 import matplotlib.pyplot as plt
 import torch.backends.cudnn as cudnn
 
@@ -13,6 +14,7 @@ import matplotlib.pyplot as plt
 import Data.cifar10 as cifar10
 import Data.cifar100 as cifar100
 import Data.tiny_imagenet as tiny_imagenet
+from Data.prefetcher import collect_logits
 
 # Import network architectures
 from Net.resnet_tiny_imagenet import resnet50 as resnet50_ti
@@ -21,13 +23,13 @@ from Net.wide_resnet import wide_resnet_cifar
 from Net.densenet import densenet121
 
 # Import metrics to compute
-from Metrics.metrics import test_classification_net_logits, ECELoss, AdaptiveECELoss, ClasswiseECELoss, ClassECELoss, posnegECELoss, binsECELoss
+from Metrics.metrics import test_classification_net_probs, softmax_stats, ECELoss, AdaptiveECELoss, ClasswiseECELoss, ClassECELoss, posnegECELoss, binsECELoss
 from Metrics.metrics import diffECELoss, posnegECEbinsLoss, ClassECELoss2, posnegECELoss2, posnegECEbinsLoss2
 from Metrics.plots import reliability_plot, pos_neg_ece_plot, ece_acc_plot, ece_iters_plot, temp_acc_plot, diff_ece_plot
 from Metrics.plots import bins_over_conf_plot, pos_neg_ece_bins_plot, temp_bins_plot, ece_bin_plot
 
 # Import temperature scaling and NLL utilities
-from temperature_scaling import ModelWithTemperature
+from temperature_scaling import ModelWithTemperature, inference_mode
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "4"
 
@@ -66,6 +68,7 @@ def parseArgs():
     model_name = None
     train_batch_size = 128
     test_batch_size = 128
+    num_workers = max(1, (os.cpu_count() or 2) // 2)
     cross_validation_error = 'ece'
     trained_loss = 'cross_entropy'
 
@@ -97,6 +100,8 @@ def parseArgs():
                         dest="train_batch_size", help="Batch size")
     parser.add_argument("-tb", type=int, default=test_batch_size,
                         dest="test_batch_size", help="Test Batch size")
+    parser.add_argument("--num-workers", type=int, default=num_workers,
+                        dest="num_workers", help="Number of data loading workers")
     parser.add_argument("--cverror", type=str, default=cross_validation_error,
                         dest="cross_validation_error", help='Error function to do temp scaling')
     parser.add_argument("-log", action="store_true", dest="log",
@@ -115,6 +120,20 @@ def parseArgs():
                         dest="init_temp", help="initial temperature for temperature scaling")
     parser.add_argument("-const_temp", action="store_true", dest="const_temp",
                         help="whether to use constant temperature on all classes")
+    parser.add_argument("-bf16_temp", action="store_true", dest="bf16_search",
+                        help="whether to compute the softmax of the temperature grid sweeps and bisections in bfloat16")
+    parser.add_argument("-fp16_temp", action="store_true", dest="fp16_search",
+                        help="whether to compute the softmax of the temperature grid sweeps and bisections in float16")
+    parser.add_argument("-coarse_temp", action="store_true", dest="coarse_search",
+                        help="whether to search the single temperature coarse-to-fine instead of scoring all 100 candidates")
+    parser.add_argument("-early_stop_temp", type=int, default=None, dest="early_stop",
+                        help="stop the single temperature search after this many candidates without improvement")
+    parser.add_argument("-bisect_temp", action="store_true", dest="bisect_bins",
+                        help="whether to solve the temperature of each bin by bisection instead of the 0.1 grid")
+    parser.add_argument("-amp_logits", action="store_true", dest="amp_forward",
+                        help="whether to compute the validation logits for temperature scaling under autocast")
+    parser.add_argument("-jacobi_temp", action="store_true", dest="jacobi_classes",
+                        help="whether to probe all the class temperatures of a pass together instead of one class at a time")
     parser.add_argument("--save-path-plots", type=str, default=save_plots_loc,
                         dest="save_plots_loc",
                         help='Path to save plots')
@@ -123,38 +142,16 @@ def parseArgs():
                         help='Trained loss(cross_entropy/focal_loss/focal_loss_adaptive/mmce/mmce_weighted/brier_score)')
     parser.add_argument("-bins", action="store_true", dest="bins_temp",
                         help="whether to calculate ECE for each bin separately")
+    parser.add_argument("-bf16", action="store_true", dest="bf16_metrics",
+                        help="whether to compute the softmax of the ECE metrics in bfloat16 (NLL and accuracy stay in float32)")
 
     return parser.parse_args()
 
 
-def get_logits_labels_const(data_loader, net, const_temp=False, bins_temp=False):
-    logits_list = []
-    labels_list = []
-    net.eval()
-    with torch.no_grad():
-        for data, label in data_loader:
-            data = data.cuda()
-            logits = net(data, label, const_temp=const_temp, bins_temp=bins_temp)
-            logits_list.append(logits)
-            labels_list.append(label)
-        logits = torch.cat(logits_list).cuda()
-        labels = torch.cat(labels_list).cuda()
-        
-        
-    return logits, labels
-
 def get_logits_labels(data_loader, net):
-    logits_list = []
-    labels_list = []
     net.eval()
-    with torch.no_grad():
-        for data, label in data_loader:
-            data = data.cuda()
-            logits = net(data)
-            logits_list.append(logits)
-            labels_list.append(label)
-        logits = torch.cat(logits_list).cuda()
-        labels = torch.cat(labels_list).cuda()
+    with inference_mode():
+        logits, labels = collect_logits(data_loader, net)
     return logits, labels
 
 
@@ -191,6 +188,7 @@ if __name__ == "__main__":
     font_size = 10
     trained_loss = args.trained_loss
     acc_check = args.acc_check
+    metrics_dtype = torch.bfloat16 if args.bf16_metrics else None
 
     # Taking input for the dataset
     num_classes = dataset_num_classes[dataset]
@@ -199,22 +197,26 @@ if __name__ == "__main__":
             root=args.dataset_root,
             split='val',
             batch_size=args.test_batch_size,
+            num_workers=args.num_workers,
             pin_memory=args.gpu)
 
         test_loader = dataset_loader[args.dataset].get_data_loader(
             root=args.dataset_root,
             split='val',
             batch_size=args.test_batch_size,
+            num_workers=args.num_workers,
             pin_memory=args.gpu)
     else:
          _, val_loader = dataset_loader[args.dataset].get_train_valid_loader(
             batch_size=args.train_batch_size,
             augment=args.data_aug,
             random_seed=1,
+            num_workers=args.num_workers,
             pin_memory=args.gpu)
 
          test_loader = dataset_loader[args.dataset].get_test_loader(
             batch_size=args.test_batch_size,
+            num_workers=args.num_workers,
             pin_memory=args.gpu)
 
     model = models[model_name]
@@ -222,43 +224,55 @@ if __name__ == "__main__":
     net = model(num_classes=num_classes, temp=1.0)
     net.cuda()
     net = torch.nn.DataParallel(net, device_ids=range(torch.cuda.device_count()))
-    cudnn.benchmark = True
+    # Only a couple of forward passes are run, the cudnn autotuner would cost more than it saves
+    cudnn.benchmark = False
     net.load_state_dict(torch.load(save_loc + args.saved_model_name), strict=False)
 
-    nll_criterion = nn.CrossEntropyLoss().cuda()
     ece_criterion = ECELoss().cuda()
     adaece_criterion = AdaptiveECELoss().cuda()
     cece_criterion = ClasswiseECELoss().cuda()
     csece_criterion = ClassECELoss().cuda()
-    posneg_csece_criterion = posnegECELoss().cuda()
-    bins_csece_criterion = binsECELoss().cuda()
-    diff_ece_criterion = diffECELoss().cuda()
-    posneg_bins_ece_criterion = posnegECEbinsLoss().cuda()
-    csece_criterion2 = ClassECELoss2().cuda()
-    posneg_csece_criterion2 = posnegECELoss2().cuda()
-    posneg_bins_ece_criterion2 = posnegECEbinsLoss2().cuda()
+    # Criteria only needed for the plots or the pos/neg analysis are built when requested
+    if create_plots:
+        diff_ece_criterion = diffECELoss().cuda()
+        csece_criterion2 = ClassECELoss2().cuda()
+    if pos_neg_ece:
+        posneg_csece_criterion = posnegECELoss().cuda()
+        bins_csece_criterion = binsECELoss().cuda()
+        posneg_bins_ece_criterion = posnegECEbinsLoss().cuda()
+        posneg_csece_criterion2 = posnegECELoss2().cuda()
+        posneg_bins_ece_criterion2 = posnegECEbinsLoss2().cuda()
 
+    # Raw test logits, the scaled ones below are derived from these without another pass
     logits, labels = get_logits_labels(test_loader, net)
-    conf_matrix, p_accuracy, _, predictions, confidences = test_classification_net_logits(logits, labels)
+    raw_logits = logits
+
+    # Softmax shared by all the metrics below
+    p_softmaxes, p_log_softmaxes, p_confs, p_preds, p_accs = softmax_stats(logits, labels, dtype=metrics_dtype)
+    p_probs = (p_softmaxes, p_confs, p_preds, p_accs, labels)
+    conf_matrix, p_accuracy, _, predictions, confidences = test_classification_net_probs(p_confs, p_preds, labels)
     
     reliability_plot(confidences, predictions, labels, save_plots_loc, dataset, args.model, trained_loss, num_bins=num_bins, scaling_related='before', save=True)
 
-    p_ece = ece_criterion(logits, labels).item()
-    p_adaece = adaece_criterion(logits, labels).item()
-    p_cece = cece_criterion(logits, labels).item()
-    p_csece2, p_acc2 = csece_criterion2(logits, labels)
-    p_csece, p_acc = csece_criterion(logits, labels)
+    p_ece = ece_criterion.forward_from_probs(*p_probs).item()
+    p_adaece = adaece_criterion.forward_from_probs(*p_probs).item()
+    p_cece = cece_criterion.forward_from_probs(*p_probs).item()
+    if create_plots:
+        p_csece2, p_acc2 = csece_criterion2(logits, labels)
+    p_csece, p_acc = csece_criterion.forward_from_probs(*p_probs)
     
     if pos_neg_ece:
         p_csece_high, p_csece_low, _ = bins_csece_criterion(logits, labels)
         p_csece_pos, p_csece_neg, p_acc = posneg_csece_criterion(logits, labels)
         p_csece_pos2, p_csece_neg2, p_acc2 = posneg_csece_criterion2(logits, labels)
+        logits_init_temp = logits / init_temp
         p_bins_ece_over2, p_bins_ece_under2, bins_vec2 = posneg_bins_ece_criterion2(logits, labels)
-        p_bins_ece_over_after2, p_bins_ece_under_after2, bins_vec2 = posneg_bins_ece_criterion2(logits / init_temp, labels)
+        p_bins_ece_over_after2, p_bins_ece_under_after2, bins_vec2 = posneg_bins_ece_criterion2(logits_init_temp, labels)
         p_bins_ece_over, p_bins_ece_under, bins_vec = posneg_bins_ece_criterion(logits, labels)
-        p_bins_ece_over_after, p_bins_ece_under_after, bins_vec = posneg_bins_ece_criterion(logits / init_temp, labels)
-    p_nll = nll_criterion(logits, labels).item()
-    _, over_conf, bins = diff_ece_criterion(logits, labels)
+        p_bins_ece_over_after, p_bins_ece_under_after, bins_vec = posneg_bins_ece_criterion(logits_init_temp, labels)
+    p_nll = -p_log_softmaxes.gather(1, labels.unsqueeze(1)).mean().item()
+    if create_plots:
+        _, over_conf, bins = diff_ece_criterion(logits, labels)
     
 
     res_str = '{:s}&{:.4f}&{:.4f}&{:.4f}&{:.4f}&{:.4f}'.format(saved_model_name,  1-p_accuracy,  p_nll,  p_ece,  p_adaece, p_cece)
@@ -274,6 +288,8 @@ if __name__ == "__main__":
                                 args.model, trained_loss, acc_check=acc_check, scaling_related='before_after2')
         
     if create_plots:
+        # Per-class results go to the host once for all the plots below
+        p_acc, p_csece, p_acc2, p_csece2 = p_acc.cpu(), p_csece.cpu(), p_acc2.cpu(), p_csece2.cpu()
         if pos_neg_ece:
             # pos and neg ECE vs. accuracy per class
             pos_neg_ece_plot(p_acc, p_csece_pos, p_csece_neg, save_plots_loc, dataset, args.model, trained_loss, acc_check=acc_check, scaling_related='before')
@@ -300,19 +316,29 @@ if __name__ == "__main__":
         print ('Classes accuracies: ' + str(p_acc))
 
 
-    scaled_model = ModelWithTemperature(net, args.log, const_temp=const_temp, bins_temp=args.bins_temp, n_bins=num_bins, iters=temp_opt_iters)
+    search_dtype = torch.bfloat16 if args.bf16_search else torch.float16 if args.fp16_search else None
+    scaled_model = ModelWithTemperature(net, args.log, const_temp=const_temp, bins_temp=args.bins_temp, n_bins=num_bins, iters=temp_opt_iters,
+                                        coarse_search=args.coarse_search,
+                                        search_dtype=search_dtype,
+                                        early_stop=args.early_stop, bisect=args.bisect_bins,
+                                        amp_forward=args.amp_forward, jacobi=args.jacobi_classes)
     if args.bins_temp:
         scaled_model.set_bins_temperature2(val_loader, cross_validate=cross_validation_error, init_temp=init_temp, acc_check=acc_check, top_temp=10)
         temp_bins_plot(scaled_model.temperature, scaled_model.bins_T, scaled_model.bin_boundaries, save_plots_loc, dataset, args.model, trained_loss, version=1)
-        logits, labels = get_logits_labels_const(test_loader, scaled_model, bins_temp=True)
+        logits = scaled_model.scale_logits(raw_logits, labels, bins_temp=True)
     else:
         scaled_model.set_temperature(val_loader, cross_validate=cross_validation_error, init_temp=init_temp, acc_check=acc_check)
-        logits, labels = get_logits_labels(test_loader, scaled_model)
-    ece = ece_criterion(logits, labels).item()
+        logits = scaled_model.scale_logits(raw_logits, labels)
+    softmaxes, log_softmaxes, confs, preds, accs = softmax_stats(logits, labels, dtype=metrics_dtype)
+    probs = (softmaxes, confs, preds, accs, labels)
+    ece = ece_criterion.forward_from_probs(*probs).item()
     
     # For const temp scaling
-    logits_const, labels_const = get_logits_labels_const(test_loader, scaled_model, const_temp=True)
-    ece_const = ece_criterion(logits_const, labels_const).item()
+    logits_const = scaled_model.scale_logits(raw_logits, labels, const_temp=True)
+    labels_const = labels
+    softmaxes_const, _, confs_const, preds_const, accs_const = softmax_stats(logits_const, labels_const, dtype=metrics_dtype)
+    probs_const = (softmaxes_const, confs_const, preds_const, accs_const, labels_const)
+    ece_const = ece_criterion.forward_from_probs(*probs_const).item()
     
     if const_temp:
         T_opt = scaled_model.get_temperature()
@@ -321,27 +347,35 @@ if __name__ == "__main__":
         if create_plots:
             ece_iters_plot(scaled_model, save_plots_loc, dataset, args.model, trained_loss, init_temp, acc_check)
             
-    conf_matrix, accuracy, _, predictions, confidences = test_classification_net_logits(logits, labels)
+    conf_matrix, accuracy, _, predictions, confidences = test_classification_net_probs(confs, preds, labels)
     reliability_plot(confidences, predictions, labels, save_plots_loc, dataset, args.model, trained_loss, num_bins=num_bins, scaling_related='after', save=True)
     
-    _, _, _, predictions_const, confidences_const = test_classification_net_logits(logits_const, labels_const)
+    _, _, _, predictions_const, confidences_const = test_classification_net_probs(confs_const, preds_const, labels_const)
     reliability_plot(confidences_const, predictions_const, labels_const, save_plots_loc, dataset, args.model,
                         trained_loss, num_bins=num_bins, scaling_related='after_const', save=True)
 
-    adaece = adaece_criterion(logits, labels).item()
-    cece = cece_criterion(logits, labels).item()
-    csece, accuracies = csece_criterion(logits, labels)
-    csece_const, accuracies_const = csece_criterion(logits_const, labels_const)
+    adaece = adaece_criterion.forward_from_probs(*probs).item()
+    cece = cece_criterion.forward_from_probs(*probs).item()
+    # Class-based, constant and uncalibrated per-class ECE in one batched pass
+    stacked_softmaxes = [softmaxes, softmaxes_const]
+    if uncalibrate_check:
+        stacked_softmaxes.append(F.softmax((logits*init_temp).to(softmaxes.dtype), dim=1))
+    stacked_csece, stacked_accuracies = csece_criterion.forward_stacked(torch.stack(stacked_softmaxes), labels)
+    csece, csece_const = stacked_csece[0], stacked_csece[1]
+    accuracies, accuracies_const = stacked_accuracies[0], stacked_accuracies[1]
     if uncalibrate_check:
-        csece_uncalibated, accuracies_uncalibated = csece_criterion(logits*init_temp, labels)
+        csece_uncalibated, accuracies_uncalibated = stacked_csece[2], stacked_accuracies[2]
     if pos_neg_ece:
         csece_high, csece_low, _ = bins_csece_criterion(logits, labels)
         csece_pos, csece_neg, accuracies = posneg_csece_criterion(logits, labels)
-    nll = nll_criterion(logits, labels).item()
+    nll = -log_softmaxes.gather(1, labels.unsqueeze(1)).mean().item()
 
     res_str += '&{:.4f}({:.2f})&{:.4f}&{:.4f}&{:.4f}'.format(nll,  T_opt,  ece,  adaece, cece)
 
     if create_plots:
+        accuracies, csece = accuracies.cpu(), csece.cpu()
+        if uncalibrate_check:
+            accuracies_uncalibated, csece_uncalibated = accuracies_uncalibated.cpu(), csece_uncalibated.cpu()
         if pos_neg_ece:
             # pos and neg ECE vs. accuracy per class
             pos_neg_ece_plot(accuracies, csece_pos, csece_neg, save_plots_loc, dataset, args.model, trained_loss, acc_check=acc_check, scaling_related='after',
@@ -11,7 +11,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 # Import metrics to compute
-from Metrics.metrics import test_classification_net_logits
+from Metrics.metrics import test_classification_net_logits, test_classification_net_probs, softmax_stats
 from Metrics.metrics import ECELoss
 from Metrics.metrics2 import ECE, softmax
 from Metrics.plots import temp_bins_plot, ece_bin_plot, logits_diff_bin_plot, reliability_plot, temp_bins_plot2
@@ -21,7 +21,7 @@ from Metrics.plots import plot_temp_different_bins, ece_iters_plot2
 from temperature_scaling import set_temperature2, temperature_scale2, class_temperature_scale2, set_temperature3, bins_temperature_scale_test3, check_movements
 
 # Import unpickling logits and labels
-from evaluate_scripts.unpickle_probs import unpickle_probs
+from evaluate_scripts.unpickle_probs import unpickle_probs, load_probs
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "3"
 
@@ -82,6 +82,24 @@ def parseArgs():
                         dest="init_temp", help="initial temperature for temperature scaling")
     parser.add_argument("-const_temp", action="store_true", dest="const_temp",
                         help="whether to use constant temperature on all classes")
+    parser.add_argument("-coarse_temp", action="store_true", dest="coarse_search",
+                        help="whether to search the temperature grids coarse-to-fine instead of scoring all 100 candidates")
+    parser.add_argument("-bisect_temp", action="store_true", dest="bisect_bins",
+                        help="whether to solve the temperature of each bin by bisection instead of the 0.1 grid")
+    parser.add_argument("-bf16_temp", action="store_true", dest="bf16_search",
+                        help="whether to compute the softmax of the temperature grid sweeps and bisections in bfloat16")
+    parser.add_argument("-fp16_temp", action="store_true", dest="fp16_search",
+                        help="whether to compute the softmax of the temperature grid sweeps and bisections in float16")
+    parser.add_argument("-warm_temp", action="store_true", dest="warm_start",
+                        help="whether to search only near the previous temperatures in the iterations after the first")
+    parser.add_argument("-early_stop_temp", type=int, default=None, dest="early_stop",
+                        help="stop the single temperature search after this many candidates without improvement")
+    parser.add_argument("-jacobi_temp", action="store_true", dest="jacobi_classes",
+                        help="whether to sweep all the class temperatures of an iteration together instead of one class at a time")
+    parser.add_argument("-golden_temp", action="store_true", dest="golden_search",
+                        help="whether to search each class temperature by golden-section instead of the 0.1 grid")
+    parser.add_argument("-cpu_temp", action="store_true", dest="cpu_search",
+                        help="whether to search the class temperatures on the CPU, faster for small validation sets")
     parser.add_argument("--save-path-plots", type=str, default=save_plots_loc,
                         dest="save_plots_loc",
                         help='Path to save plots')
@@ -143,7 +161,15 @@ if __name__ == "__main__":
     file = logits_path + logits_file
     #file1 = logits_path + logits_file1
     #file2 = logits_path + logits_file2
-    (logits_val, labels_val), (logits_test, labels_test) = unpickle_probs(file)
+    if file.endswith('.pt'):
+        # Converted with convert_probs, the tensors are loaded directly on the GPU
+        (logits_val, labels_val), (logits_test, labels_test) = load_probs(file, device='cuda')
+    else:
+        (logits_val, labels_val), (logits_test, labels_test) = unpickle_probs(file)
+        logits_val = torch.from_numpy(logits_val).cuda()
+        labels_val = torch.squeeze(torch.from_numpy(labels_val), -1).cuda()
+        logits_test = torch.from_numpy(logits_test).cuda()
+        labels_test = torch.squeeze(torch.from_numpy(labels_test), -1).cuda()
     #(logits_val1, labels_val1), (logits_test1, labels_test1) = unpickle_probs(file1)
     #(logits_val2, labels_val2), (logits_test2, labels_test2) = unpickle_probs(file2)
     
@@ -153,11 +179,7 @@ if __name__ == "__main__":
     confs = np.max(softmaxs, axis=1)
     p_ece= ECE(confs, preds, labels_test, bin_size = 1/num_bins) 
     """
-    
-    logits_val = torch.from_numpy(logits_val).cuda()
-    labels_val = torch.squeeze(torch.from_numpy(labels_val), -1).cuda()
-    logits_test = torch.from_numpy(logits_test).cuda()
-    labels_test = torch.squeeze(torch.from_numpy(labels_test), -1).cuda()
+
 
     """
     logits_val1 = torch.from_numpy(logits_val1).cuda()
@@ -172,34 +194,45 @@ if __name__ == "__main__":
     #before_indices, after_indices = check_movements(logits_val, const=2)
     #plot_temp_different_bins(save_plots_loc)
     
-    p_ece = ece_criterion(logits_test, labels_test).item()
+    # Softmax of the test logits shared by the metrics, the plot and the bins test below
+    test_stats = softmax_stats(logits_test, labels_test)
+    test_softmaxes, _, test_confs, test_preds, test_accs = test_stats
+    p_ece = ece_criterion.forward_from_probs(test_softmaxes, test_confs, test_preds, test_accs, labels_test).item()
     #p_ece2 = ece_criterion(logits_test2, labels_test2).item()
-    _, p_acc, _, _, _ = test_classification_net_logits(logits_test, labels_test)
+    _, p_acc, _, predictions, confidences = test_classification_net_probs(test_confs, test_preds, labels_test)
     
     # Printing the required evaluation metrics
     if args.log:
         print('Pre-scaling test ECE: ' + str(p_ece))
         print('Pre-scaling test accuracy: ' + str(p_acc))
 
+    search_dtype = torch.bfloat16 if args.bf16_search else torch.float16 if args.fp16_search else None
     if args.bins_temp:
-        _, _, _, predictions, confidences = test_classification_net_logits(logits_test, labels_test)
         reliability_plot(confidences, predictions, labels_test, save_plots_loc, dataset, args.model, trained_loss, num_bins=num_bins, scaling_related='before', save=True)
         if const_temp:
             temperature = set_temperature3(logits_val, labels_val, temp_opt_iters, cross_validate=cross_validation_error,
-                                        init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins, top_temp=1.2)
+                                        init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins, top_temp=1.2,
+                                        coarse=args.coarse_search, dtype=search_dtype, patience=args.early_stop)
         else:                              
             bins_T, single_temp, bin_boundaries, many_samples, best_iter = set_temperature3(logits_val, labels_val, temp_opt_iters, cross_validate=cross_validation_error, init_temp=init_temp,
-                                                                                                    acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins, top_temp=1.2)
+                                                                                                    acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins, top_temp=1.2,
+                                                                                                    coarse=args.coarse_search, bisect=args.bisect_bins, dtype=search_dtype,
+                                                                                                    warm_start=args.warm_start)
             #bins_T2, single_temp2, bin_boundaries2, many_samples2, best_iter2 = set_temperature3(logits_val2, labels_val2, temp_opt_iters, cross_validate=cross_validation_error, init_temp=init_temp,
             #                                                                                    acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins, top_temp=1.2)
         
     else:    
         if const_temp:
             temperature = set_temperature2(logits_val, labels_val, temp_opt_iters, cross_validate=cross_validation_error,
-                                        init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins)
+                                        init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins,
+                                        coarse=args.coarse_search, dtype=search_dtype, patience=args.early_stop)
         else:                              
             csece_temperature, single_temp = set_temperature2(logits_val, labels_val, temp_opt_iters, cross_validate=cross_validation_error,
-                                                            init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins)
+                                                            init_temp=init_temp, acc_check=acc_check, const_temp=const_temp, log=args.log, num_bins=num_bins,
+                                                            coarse=args.coarse_search, jacobi=args.jacobi_classes, dtype=search_dtype,
+                                                            warm_start=args.warm_start, patience=args.early_stop,
+                                                            golden=args.golden_search,
+                                                            search_device='cpu' if args.cpu_search else None)
     
     """
     softmaxs = softmax(class_temperature_scale2(logits_test, csece_temperature))
@@ -216,7 +249,8 @@ if __name__ == "__main__":
         scaled_logits, ece_bin, single_ece_bin, origin_ece_bin, ece_list = bins_temperature_scale_test3(logits_test, labels_test, bins_T,
                                                                                                         args.temp_opt_iters,
                                                                                                         bin_boundaries, many_samples,
-                                                                                                        single_temp, best_iter, num_bins)
+                                                                                                        single_temp, best_iter, num_bins,
+                                                                                                        stats=test_stats)
         #scaled_logits2, ece_bin2, single_ece_bin2, origin_ece_bin2, ece_list2 = bins_temperature_scale_test3(logits_test2, labels_test2, bins_T2,
         #                                                                                                    args.temp_opt_iters,
         #                                                                                                    bin_boundaries2, many_samples2,
@@ -227,11 +261,12 @@ if __name__ == "__main__":
         #ece_single2 = ece_criterion(temperature_scale2(logits_test, single_temp2), labels_test).item()
         #ece_iters_plot2(ece_single, ece_single2, ece_list, ece_list2, save_plots_loc, dataset, args.model, 
         #                trained_loss, divide=args.divide, ds='val_two_models_iters', version=2)
-        _, _, _, predictions, confidences = test_classification_net_logits(scaled_logits, labels_test)
+        scaled_softmaxes, _, scaled_confs, scaled_preds, scaled_accs = softmax_stats(scaled_logits, labels_test)
+        _, _, _, predictions, confidences = test_classification_net_probs(scaled_confs, scaled_preds, labels_test)
         reliability_plot(confidences, predictions, labels_test, save_plots_loc, dataset, args.model, trained_loss, num_bins=num_bins, scaling_related='after', save=True)
         ece_bin_plot(ece_bin, single_ece_bin, origin_ece_bin, save_plots_loc, dataset, args.model, trained_loss,
                        divide=args.divide, ds='test', version=2)
-        ece = ece_criterion(scaled_logits, labels_test).item()
+        ece = ece_criterion.forward_from_probs(scaled_softmaxes, scaled_confs, scaled_preds, scaled_accs, labels_test).item()
     else:
         ece = ece_criterion(class_temperature_scale2(logits_test, csece_temperature), labels_test).item()
     _, _, _, predictions, confidences = test_classification_net_logits(temperature_scale2(logits_test, single_temp), labels_test)
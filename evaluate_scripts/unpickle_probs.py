@@ -1,6 +1,7 @@
 # Method for unpickling probabilities/logits saved in process of evaluation.
 
 import pickle
+import torch
 
 # Example of unpickle
 FILE_PATH = 'probs_resnet110_c10.p'
@@ -18,6 +19,21 @@ def unpickle_probs(file, verbose = 0):
         print("y_true_test:", y_test.shape)  # (10000, 1); Test set true labels
         
     return ((y_probs_val, y_val), (y_probs_test, y_test))
+
+
+# Re-save the pickled logits as a torch file of tensors (labels squeezed to 1-D), done once per file
+def convert_probs(file, out_file):
+    (y_probs_val, y_val), (y_probs_test, y_test) = unpickle_probs(file)
+    torch.save({'logits_val': torch.from_numpy(y_probs_val),
+                'labels_val': torch.squeeze(torch.from_numpy(y_val), -1),
+                'logits_test': torch.from_numpy(y_probs_test),
+                'labels_test': torch.squeeze(torch.from_numpy(y_test), -1)}, out_file)
+
+
+# Load a file written by convert_probs straight onto the given device
+def load_probs(file, device='cpu'):
+    probs = torch.load(file, map_location=device)
+    return ((probs['logits_val'], probs['labels_val']), (probs['logits_test'], probs['labels_test']))
     
     
 if __name__ == '__main__':
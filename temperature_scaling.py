@@ -8,12 +8,18 @@ from torch import nn, optim
 from torch.nn import functional as F
 import math
 
-from Metrics.metrics import test_classification_net_logits
-from Metrics.metrics import ECELoss, ClassECELoss, posnegECELoss, estECELoss
+from Metrics.metrics import test_classification_net_logits, test_classification_net_probs, softmax_stats, \
+    scaled_softmax_max, softmax_max, softmax_top, candidates_softmax_max, candidates_nll
+from Metrics.metrics import ECELoss, estECELoss, bin_sums, batched_bin_sums, equal_mass_bin_edges, nll_ece, \
+    ece_score, scaled_ece
 from Metrics.metrics2 import ECE, softmax, test_classification_net_logits2
+from Data.prefetcher import collect_logits
 
 torch.set_printoptions(precision=10)
 
+# torch.inference_mode needs PyTorch 1.9, older versions fall back to no_grad
+inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
+
 class ModelWithTemperature(nn.Module):
     """
     A thin decorator, which wraps a model with temperature scaling
@@ -22,7 +28,8 @@ class ModelWithTemperature(nn.Module):
         NB: Output of the neural network should be the classification logits,
             NOT the softmax (or log softmax)!
     """
-    def __init__(self, model, log=True, const_temp=False, bins_temp=False, n_bins=15, iters=1):
+    def __init__(self, model, log=True, const_temp=False, bins_temp=False, n_bins=15, iters=1, coarse_search=False,
+                 search_dtype=None, early_stop=None, bisect=False, amp_forward=False, jacobi=False):
         super(ModelWithTemperature, self).__init__()
         self.model = model
         self.temperature = 1.0
@@ -33,13 +40,30 @@ class ModelWithTemperature(nn.Module):
         self.bins_temp = bins_temp
         self.n_bins = n_bins
         self.iters = iters  # Number of maximum iterations
-        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1).unsqueeze(0).repeat((iters, 1)).numpy()
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1).unsqueeze(0).repeat((iters, 1)).cuda()
         self.best_iter = 0  # Best iteration for scaling
         self.temps_iters = torch.ones(iters).cuda()  # Temperatures fot iter single TS
+        self.temp_steps = torch.linspace(-0.2, 0.2, 5).cuda()  # Step offsets tried around a class or bin temperature
+        self.ece_boundaries = torch.linspace(0, 1, n_bins + 1)  # ECE bins of bins_temperature_scale_test
+        self.coarse_search = coarse_search  # Coarse-to-fine search of the single temperature grid
+        self.search_dtype = search_dtype  # Softmax precision of the temperature grid sweeps and bisections (None: logits dtype)
+        self.early_stop = early_stop  # Patience of the single temperature grid search (None: score all candidates)
+        self.bisect = bisect  # Solve the temperature of every bin by bisection instead of the 0.1 grid
+        self.amp_forward = amp_forward  # Run the validation forward pass under autocast, the logits are kept in float32
+        self.jacobi = jacobi  # Probe the step offsets of all the class temperatures of a pass together
+        self.valid_loader = None  # Loader of the cached validation logits
+        self.valid_logits = None
+        self.valid_labels = None
 
 
     def forward(self, input, labels, const_temp=False, bins_temp=False):
         logits = self.model(input)
+        return self.scale_logits(logits, labels, const_temp=const_temp, bins_temp=bins_temp)
+
+    def scale_logits(self, logits, labels, const_temp=False, bins_temp=False):
+        """
+        Apply the tuned temperatures to logits already produced by the wrapped model
+        """
         if self.const_temp or const_temp:
             #return self.temperature_scale(logits)
             return self.iter_temperature_scale(logits)
@@ -60,11 +84,11 @@ class ModelWithTemperature(nn.Module):
         """
         Perform iterative temperature scaling on logits
         """
-        scaled_logits = logits.clone()
-        for i in range(self.iters):
-            scaled_logits = scaled_logits / self.temps_iters[i]
-        # Expand temperature to match the size of logits
-        return scaled_logits
+        # The slice below would silently stop at the stored temperatures, where indexing them raised
+        if self.iters > self.temps_iters.shape[0]:
+            raise IndexError('{} iterations but only {} iteration temperatures'.format(self.iters, self.temps_iters.shape[0]))
+        # The successive divisions are folded into one by the product of the (non-zero) iteration temperatures
+        return logits / self.temps_iters[:self.iters].prod()
     
     def class_temperature_scale(self, logits):
         """
@@ -77,42 +101,36 @@ class ModelWithTemperature(nn.Module):
         """
         Perform temperature scaling on logits
         """
-        ece_criterion = ECELoss(n_bins=n_bins).cuda()
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
+        ece_boundaries = self.ece_boundaries if n_bins == self.n_bins else torch.linspace(0, 1, n_bins + 1)
+        confidences, predictions = softmax_top(logits)
         accuracies = predictions.eq(labels)
         # confidences[confidences == 1] = 0.999999
-        scaled_logits = logits.clone()
+        scaled_logits = logits
         ece_list = []
+        ones = torch.ones_like(confidences)
         for i in range(self.best_iter + 1):
-            bin = 0
-            bin_lowers = self.bin_boundaries[i][:-1]
-            bin_uppers = self.bin_boundaries[i][1:]
-            print('\n')
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                accuracies_temp = accuracies[in_bin]
-                # accuracy_in_bin = accuracies_temp.float().mean().item()
-                accuracy_in_bin = min(accuracies_temp.float().mean().item(), 0.99)
-                accuracy_in_bin = max(accuracy_in_bin, 0.01)
-                if any(in_bin):
-                    scaled_logits[in_bin] = scaled_logits[in_bin] / self.bins_T[bin, i]
-                    softmaxes_temp = F.softmax(scaled_logits[in_bin], dim=1)
-                    confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                    avg_confidence_in_bin = confidences_temp.mean()
-                    after_temperature = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                    samples = scaled_logits[in_bin].shape[0]
-                    print('ece in bin ', bin + 1, ' :', (prop_in_bin * after_temperature).item(),
-                          ', number of samples: ', samples)
-                    print('accuracy in bin ', bin + 1, ': ', accuracy_in_bin)
-                bin += 1
+            # Each sample is divided by the temperature of its (lower, upper] bin in one op
+            bin_boundaries = self.bin_boundaries[i].to(device=confidences.device, dtype=confidences.dtype)
+            num_bins = bin_boundaries.shape[0] - 1
+            bin_idx = bin_indices(confidences, bin_boundaries)
+            bins_T = torch.where(bin_idx.lt(num_bins), self.bins_T[bin_idx.clamp(max=num_bins - 1), i], ones)
+            scaled_logits = logits / bins_T.unsqueeze(1) if i == 0 else scaled_logits.div_(bins_T.unsqueeze(1))
+            scaled_confidences = softmax_max(scaled_logits)
+            if self.log:
+                print('\n')
+                ece, count, accuracy, _ = bins_ece(scaled_confidences, accuracies, bin_idx, num_bins)
+                for bin, (samples, bin_ece, accuracy_in_bin) in enumerate(zip(*torch.stack([count, ece, accuracy]).tolist())):
+                    if samples > 0:
+                        accuracy_in_bin = min(accuracy_in_bin, 0.99)
+                        accuracy_in_bin = max(accuracy_in_bin, 0.01)
+                        print('ece in bin ', bin + 1, ' :', bin_ece,
+                              ', number of samples: ', int(samples))
+                        print('accuracy in bin ', bin + 1, ': ', accuracy_in_bin)
 
-            ece_list.append(ece_criterion(scaled_logits, labels).item())
-            softmaxes = F.softmax(scaled_logits, dim=1)
-            confidences, _ = torch.max(softmaxes, 1)
+            ece_list.append(ece_score(scaled_confidences, accuracies, ece_boundaries))
+            confidences = scaled_confidences
 
-        print(ece_list)
+        print(torch.cat(ece_list).tolist())
         print('Number of iters: {}'.format(self.best_iter + 1))
 
         return scaled_logits
@@ -121,105 +139,77 @@ class ModelWithTemperature(nn.Module):
         """
         Perform temperature scaling on logits
         """     
-        # Expand temperature to match the size of logits
-        return logits / torch.unsqueeze(self.bece_temperature, -1)
+        # The sample temperatures are a column, so they broadcast over the classes as they are
+        return logits / self.bece_temperature
     
 
+    def get_valid_logits(self, valid_loader):
+        """
+        Logits and labels of the validation set, computed once per loader and reused by the set_*temperature calls.
+        The batch copies only overlap the forward pass when the loader is built with pin_memory=True
+        """
+        if self.valid_loader is not valid_loader:
+            self.model.eval()
+            with inference_mode(), torch.cuda.amp.autocast(enabled=self.amp_forward):
+                self.valid_logits, self.valid_labels = collect_logits(valid_loader, self.model)
+            self.valid_loader = valid_loader
+        return self.valid_logits, self.valid_labels
+
+    @inference_mode()
     def set_temperature(self, valid_loader, cross_validate='ece', init_temp=2.5, acc_check=False):
         """
         Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL
         """
+        self.cuda()
+        self.model.eval()
+
+        # First: collect all the logits and labels for the validation set
+        logits, labels = self.get_valid_logits(valid_loader)
+
+        return self.set_temperature_from_logits(logits, labels, cross_validate=cross_validate,
+                                                init_temp=init_temp, acc_check=acc_check)
+
+    @inference_mode()
+    def set_temperature_from_logits(self, logits, labels, cross_validate='ece', init_temp=2.5, acc_check=False):
+        """
+        Tune the tempearature on precomputed validation logits and labels with cross-validation on ECE or NLL
+        """
+        self.cuda()
+        logits = logits.cuda(non_blocking=True)
+        labels = labels.cuda(non_blocking=True)
         if self.const_temp:
-            self.cuda()
-            self.model.eval()
-            nll_criterion = nn.CrossEntropyLoss().cuda()
             ece_criterion = ECELoss().cuda()
 
-            # First: collect all the logits and labels for the validation set
-            logits_list = []
-            labels_list = []
-            with torch.no_grad():
-                for input, label in valid_loader:
-                    input = input.cuda()
-                    logits = self.model(input)
-                    logits_list.append(logits)
-                    labels_list.append(label)
-                logits = torch.cat(logits_list).cuda()
-                labels = torch.cat(labels_list).cuda()
-
-            # Calculate NLL and ECE before temperature scaling
-            before_temperature_nll = nll_criterion(logits, labels).item()
-            before_temperature_ece = ece_criterion(logits, labels).item()
+            # Calculate NLL and ECE before temperature scaling, from one log-softmax
+            before_temperature_nll, before_temperature_ece = torch.cat(
+                nll_ece(logits, labels, ece_criterion.bin_boundaries)).tolist()
             if self.log:
                 print('Before temperature - NLL: %.3f, ECE: %.3f' % (before_temperature_nll, before_temperature_ece))
 
-            nll_val = 10 ** 7
-            ece_val = 10 ** 7
-            T_opt_nll = 1.0
-            T_opt_ece = 1.0
-            T = 0.1
-            for i in range(100):
-                self.temperature = T
-                self.cuda()
-                after_temperature_nll = nll_criterion(self.temperature_scale(logits), labels).item()
-                after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
-                if nll_val > after_temperature_nll:
-                    T_opt_nll = T
-                    nll_val = after_temperature_nll
-
-                if ece_val > after_temperature_ece:
-                    T_opt_ece = T
-                    ece_val = after_temperature_ece
-                T += 0.1
-
-            if cross_validate == 'ece':
-                self.temperature = T_opt_ece
-            else:
-                self.temperature = T_opt_nll
-            self.cuda()
+            # Candidates T = 0.1, 0.2, ..., 10 scored in batched sweeps
+            temperatures = temperature_grid(0.1, 0.1, 100)
+            self.temperature = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                                  cross_validate=cross_validate, coarse=self.coarse_search, dtype=self.search_dtype,
+                                                  patience=self.early_stop)
 
             # Calculate NLL and ECE after temperature scaling
-            after_temperature_nll = nll_criterion(self.temperature_scale(logits), labels).item()
-            after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
+            after_temperature_nll, after_temperature_ece = torch.cat(
+                nll_ece(self.temperature_scale(logits), labels, ece_criterion.bin_boundaries)).tolist()
             if self.log:
                 print('Optimal temperature: %.3f' % self.temperature)
                 print('After temperature - NLL: %.3f, ECE: %.3f' % (after_temperature_nll, after_temperature_ece))
         
         else:
-            self.cuda()
-            self.model.eval()
-            nll_criterion = nn.CrossEntropyLoss().cuda()
             ece_criterion = ECELoss().cuda()
-            csece_criterion = ClassECELoss().cuda()
-            posneg_csece_criterion = posnegECELoss().cuda()
-
-            # First: collect all the logits and labels for the validation set
-            logits_list = []
-            labels_list = []
-            with torch.no_grad():
-                for input, label in valid_loader:
-                    input = input.cuda()
-                    logits = self.model(input)
-                    logits_list.append(logits)
-                    labels_list.append(label)
-                logits = torch.cat(logits_list).cuda()
-                labels = torch.cat(labels_list).cuda()
 
             before_temperature_ece = ece_criterion(logits, labels).item()
             if self.log:
                 print('Before temperature - ECE: %.3f' % (before_temperature_ece))
 
-            ece_val = 10 ** 7
-            T_opt_ece = 1.0
-            T = 0.1
-            for i in range(100):
-                self.temperature = T
-                self.cuda()
-                after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
-                if ece_val > after_temperature_ece:
-                    T_opt_ece = T
-                    ece_val = after_temperature_ece
-                T += 0.1
+            temperatures = temperature_grid(0.1, 0.1, 100)
+            T_opt_ece = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                           coarse=self.coarse_search, dtype=self.search_dtype,
+                                           patience=self.early_stop)
 
             init_temp = T_opt_ece
             self.temperature = T_opt_ece
@@ -233,98 +223,97 @@ class ModelWithTemperature(nn.Module):
             """
             Find tempearature vector for the model (using the validation set) with cross-validation on ECE
             """
-            T_opt_nll = 1.0
-            T_opt_ece = 1.0
-            T_opt_csece = init_temp*torch.ones(logits.size()[1]).cuda()
-            T_csece = init_temp*torch.ones(logits.size()[1]).cuda()
+            T_opt_csece = torch.full((logits.size(1),), init_temp, device=logits.device)
+            T_csece = torch.full((logits.size(1),), init_temp, device=logits.device)
             self.csece_temperature = T_csece
-            self.ece_list.append(ece_criterion(self.class_temperature_scale(logits), labels).item())
+            # Kept equal to logits / T_csece by rescaling a single column whenever a class temperature moves
+            scaled_logits = logits / T_csece
+            self.ece_list.append(ece_criterion(scaled_logits, labels).item())
             _, accuracy, _, _, _ = test_classification_net_logits(logits, labels)
             if acc_check:
-                _, temp_accuracy, _, _, _ = test_classification_net_logits(self.class_temperature_scale(logits), labels)
+                _, temp_accuracy, _, _, _ = test_classification_net_logits(scaled_logits, labels)
                 if temp_accuracy >= accuracy:
                     accuracy = temp_accuracy
             
-            steps_limit = 0.2
-            temp_steps = torch.linspace(-steps_limit, steps_limit, int((2 * steps_limit) / 0.1 + 1))
+            temp_steps = self.temp_steps
             converged = False
             prev_temperatures = self.csece_temperature.clone()
-            nll_val = 10 ** 7
-            ece_val = 10 ** 7
-            csece_val = 10 ** 7
+            csece_val = torch.full((1,), 10.0 ** 7, device=logits.device)
                  
             #for iter in range(self.iters):
             while not converged:
-                for label in range(logits.size()[1]):
-                    init_temp_value = T_csece[label].item()
-                    #T = 0.1
-                    """
-                    nll_val = 10 ** 7
-                    ece_val = 10 ** 7
-                    csece_val = 10 ** 7
-                    """
-                    #for i in range(100):
-                    for step in temp_steps:
-                        #T_csece[label] = T
-                        T_csece[label] = init_temp_value + step
-                        self.csece_temperature = T_csece
-                        #self.temperature = T
-                        self.cuda()
-                        #after_temperature_nll = nll_criterion(self.temperature_scale(logits), labels).item()
-                        after_temperature_ece = ece_criterion(self.class_temperature_scale(logits), labels).item()
-                        #after_temperature_ece_reg = ece_criterion(self.temperature_scale(logits), labels).item()
-                        if acc_check:
-                            _, temp_accuracy, _, _, _ = test_classification_net_logits(self.class_temperature_scale(logits), labels)
-                        
-                        """
-                        if nll_val > after_temperature_nll:
-                            T_opt_nll = T
-                            nll_val = after_temperature_nll
-                        
-
-                        if ece_val > after_temperature_ece_reg:
-                            T_opt_ece = T
-                            ece_val = after_temperature_ece_reg
-                        """
-
-                        if acc_check:
+                if acc_check:
+                    for label in range(logits.size()[1]):
+                        # All step offsets of this class's temperature in one batched sweep
+                        candidates = T_csece[label] + temp_steps
+                        candidate_eces, candidate_accs = sweep_class_temperature(
+                            logits, scaled_logits, label, candidates, labels, ece_criterion.bin_boundaries)
+                        for temp, after_temperature_ece, temp_accuracy in zip(
+                                *torch.stack([candidates, candidate_eces, candidate_accs]).tolist()):
                             if csece_val > after_temperature_ece and temp_accuracy >= accuracy:
-                                T_opt_csece[label] = T
+                                T_opt_csece[label] = temp
                                 csece_val = after_temperature_ece
                                 accuracy = temp_accuracy
-                        else:
-                            if csece_val > after_temperature_ece:
-                                #T_opt_csece[label] = T
-                                T_opt_csece[label] = init_temp_value + step
-                                csece_val = after_temperature_ece
-                        #T += 0.1
-                    T_csece[label] = T_opt_csece[label]
+                        T_csece[label] = T_opt_csece[label]
+                        scaled_logits[:, label] = logits[:, label] / T_csece[label]
+                elif self.jacobi:
+                    # The step offsets of every class probed against the temperatures at the start of the pass
+                    classes = torch.arange(logits.size(1), device=logits.device)
+                    candidates = T_opt_csece.unsqueeze(1) + temp_steps
+                    class_eces, _ = sweep_classes_temperature(logits, scaled_logits, classes, candidates, labels,
+                                                              ece_criterion.bin_boundaries)
+                    best = torch.argmin(class_eces, 1)
+                    best_eces = class_eces.gather(1, best.unsqueeze(1)).squeeze(1)
+                    improved = best_eces < csece_val
+                    moved = torch.where(improved, candidates.gather(1, best.unsqueeze(1)).squeeze(1), T_opt_csece)
+                    moved_ece = scaled_ece(logits, moved, labels, ece_criterion.bin_boundaries)
+                    # Moving all the classes together can overshoot, then only the best single class moves
+                    if moved_ece.item() >= csece_val.item():
+                        improved = improved & classes.eq(torch.argmin(best_eces))
+                        moved = torch.where(improved, candidates.gather(1, best.unsqueeze(1)).squeeze(1), T_opt_csece)
+                        moved_ece = torch.where(improved.any(), best_eces.min(), csece_val).view(1)
+                    csece_val = moved_ece
+                    T_opt_csece.copy_(moved)
+                    T_csece.copy_(T_opt_csece)
+                    torch.div(logits, T_csece, out=scaled_logits)
+                else:
+                    csece_val = class_temperatures_pass(logits, scaled_logits, T_opt_csece, csece_val, temp_steps,
+                                                        labels, ece_criterion.bin_boundaries)
+                    T_csece.copy_(T_opt_csece)
                 self.csece_temperature = T_opt_csece
-                self.ece_list.append(ece_criterion(self.class_temperature_scale(logits), labels).item())
-                converged = torch.all(self.csece_temperature.eq(prev_temperatures))
-                prev_temperatures = self.csece_temperature.clone()
+                self.ece_list.append(ece_criterion(scaled_logits, labels).item())
+                converged = torch.equal(self.csece_temperature, prev_temperatures)
+                prev_temperatures.copy_(self.csece_temperature)
 
-            """
-            if cross_validate == 'ece':
-                self.temperature = T_opt_ece
-            else:
-                self.temperature = T_opt_nll
-            """
             self.csece_temperature = T_opt_csece
-            self.cuda()
-            """
-            # Calculate NLL and ECE after temperature scaling
-            after_temperature_nll = nll_criterion(self.temperature_scale(logits), labels).item()
-            after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
-            after_temperature_csece, _ = csece_criterion(self.class_temperature_scale(logits), labels)
-            self.ece = ece_criterion(self.temperature_scale(logits), labels).item()
-            if self.log:
-                print('Optimal temperature: %.3f' % self.temperature)
-                print('After temperature - NLL: {0:.3f}, ECE: {1:.3f}, classECE: {2}'.format(after_temperature_nll, after_temperature_ece, after_temperature_csece))
-            """
         return self
 
 
+    @classmethod
+    @inference_mode()
+    def calibrate_batch(cls, models, valid_loader, cross_validate='ece', log=True):
+        """
+        Tune a constant temperature for each of several models with one pass over the validation set,
+        scoring the temperature grid of all the models in the same batched sweeps
+        """
+        scaled_models = [cls(model, log=log, const_temp=True).cuda() for model in models]
+        for scaled_model in scaled_models:
+            scaled_model.model.eval()
+        logits, labels = collect_logits(
+            valid_loader, lambda input: torch.stack([scaled_model.model(input) for scaled_model in scaled_models], 1))
+        logits = logits.transpose(0, 1).contiguous()
+
+        ece_criterion = ECELoss().cuda()
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        after_temperature_ece, after_temperature_nll = sweep_model_temperatures(
+            logits, labels, torch.tensor(temperatures, device=logits.device), ece_criterion.bin_boundaries)
+        after_temperature = after_temperature_ece if cross_validate == 'ece' else after_temperature_nll
+        for scaled_model, best in zip(scaled_models, torch.argmin(after_temperature, dim=1).tolist()):
+            scaled_model.temperature = temperatures[best]
+            if log:
+                print('Optimal temperature: %.3f' % scaled_model.temperature)
+        return scaled_models
+
     def get_temperature(self):
         if self.const_temp:
             return self.temperature
@@ -333,45 +322,29 @@ class ModelWithTemperature(nn.Module):
         else:
             return self.temperature, self.csece_temperature
         
+    @inference_mode()
     def set_bins_temperature(self, valid_loader, cross_validate='ece', init_temp=2.5, acc_check=False, n_bins=15):
         """
         Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL
         """
         self.cuda()
         self.model.eval()
-        nll_criterion = nn.CrossEntropyLoss().cuda()
         ece_criterion = ECELoss().cuda()
 
         # First: collect all the logits and labels for the validation set
-        logits_list = []
-        labels_list = []
-        with torch.no_grad():
-            for input, label in valid_loader:
-                input = input.cuda()
-                logits = self.model(input)
-                logits_list.append(logits)
-                labels_list.append(label)
-            logits = torch.cat(logits_list).cuda()
-            labels = torch.cat(labels_list).cuda()
+        logits, labels = self.get_valid_logits(valid_loader)
 
         # Calculate NLL and ECE before temperature scaling
-        before_temperature_nll = nll_criterion(logits, labels).item()
-        before_temperature_ece = ece_criterion(logits, labels).item()
         if self.log:
+            before_temperature_nll, before_temperature_ece = torch.cat(
+                nll_ece(logits, labels, ece_criterion.bin_boundaries)).tolist()
             print('Before temperature - NLL: %.3f, ECE: %.3f' % (before_temperature_nll, before_temperature_ece))
             
         eps = 1e-6
-        ece_val = 10 ** 7
-        T_opt_ece = 1.0
-        T = 0.1
-        for i in range(100):
-            self.temperature = T
-            self.cuda()
-            after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
-            if ece_val > after_temperature_ece:
-                T_opt_ece = T
-                ece_val = after_temperature_ece
-            T += 0.1
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        T_opt_ece = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                       coarse=self.coarse_search, dtype=self.search_dtype,
+                                       patience=self.early_stop)
 
         init_temp = T_opt_ece
         self.temperature = T_opt_ece
@@ -382,125 +355,107 @@ class ModelWithTemperature(nn.Module):
             print('Optimal temperature: %.3f' % init_temp)
             print('After temperature - ECE: %.3f' % (after_temperature_ece))
 
-        T_opt_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-        T_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-        self.bins_T = init_temp*torch.ones(n_bins).cuda()
+        # One temperature per sample, kept as a column
+        T_opt_bece = torch.full((logits.shape[0], 1), init_temp, device=logits.device)
+        T_bece = torch.full((logits.shape[0], 1), init_temp, device=logits.device)
+        self.bins_T = torch.full((n_bins,), init_temp, device=logits.device)
         #bins_T_opt = init_temp*torch.ones(n_bins).cuda()
         self.bece_temperature = T_bece
         
-        self.ece_list.append(ece_criterion(self.temperature_scale(logits), labels).item())
+        self.ece_list.append(after_temperature_ece)
         _, accuracy, _, _, _ = test_classification_net_logits(logits, labels)
         if acc_check:
             _, temp_accuracy, _, _, _ = test_classification_net_logits(self.temperature_scale(logits), labels)
             if temp_accuracy >= accuracy:
                 accuracy = temp_accuracy
         
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, _ = torch.max(softmaxes, 1)
+        # Only the scaled confidences of a bin's samples are refreshed when its temperature changes
+        confidences, predictions = softmax_top(logits)
+        accuracies = predictions.eq(labels)
+        sample_confidences = scaled_softmax_max(logits, T_bece)
         
-        steps_limit = 0.2
-        temp_steps = torch.linspace(-steps_limit, steps_limit, int((2 * steps_limit) / 0.1 + 1)).cuda()
+        temp_steps = self.temp_steps
         converged = False
         prev_temperatures = self.bece_temperature.clone()
         #prev_temperatures = self.bins_T.clone()
-        bece_val = 10 ** 7
+        bece_val = 10 ** 7 if acc_check else torch.full((1,), 10.0 ** 7, device=logits.device)
         
         bin_boundaries = torch.linspace(0, 1, n_bins + 1)
-        bin_lowers = bin_boundaries[:-1]
-        bin_uppers = bin_boundaries[1:]
+        # The confidences are not rescaled below, so the bins are found once
+        _, order, counts = bin_order(confidences, bin_boundaries.to(confidences.device))
+        shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+        bin_samples = []
+        start = 0
+        for bin, samples in enumerate(counts.tolist()):
+            if samples > 0:
+                in_bin = order[start:start + samples]
+                bin_samples.append((bin, in_bin, shifted[in_bin]))
+            start += samples
                 
         self.iters = 0
         while not converged:
             self.iters += 1
-            bin = 0
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
+            for bin, in_bin, bin_shifted in bin_samples:
                 #prop_in_bin = in_bin.float().mean()
-                if any(in_bin):
-                    init_temp_value = T_bece[in_bin][0].item()
-                    #init_temp_value = self.bins_T[bin].item()
-                    for step in temp_steps:
-                        T_bece[in_bin] = init_temp_value + step
-                        self.bece_temperature = T_bece
-                        #self.bins_T[bin] = init_temp_value + step
-                        self.cuda()
-                        after_temperature_ece = ece_criterion(self.bins_temperature_scale(logits), labels).item()
-                        if acc_check:
-                            _, temp_accuracy, _, _, _ = test_classification_net_logits(self.bins_temperature_scale(logits), labels)
-
-                        if acc_check:
-                            if bece_val > after_temperature_ece + eps and temp_accuracy >= accuracy:
-                                T_opt_bece[in_bin] = init_temp_value + step
-                                #bins_T_opt[bin] = init_temp_value + step
-                                bece_val = after_temperature_ece
-                                accuracy = temp_accuracy
-                        else:
-                            if bece_val > after_temperature_ece + eps:
-                                T_opt_bece[in_bin] = init_temp_value + step
-                                #bins_T_opt[bin] = init_temp_value + step
-                                bece_val = after_temperature_ece
-                    T_bece[in_bin] = T_opt_bece[in_bin]
-                    #self.bins_T[bin] = bins_T_opt[bin]
-                    self.bins_T[bin] = T_bece[in_bin][0].item()
-                bin += 1
+                candidates = T_bece[in_bin[:1], 0] + temp_steps
+                # ECE of every step offset of this bin's temperature from one fused pass
+                candidate_eces, candidate_accs = sweep_bin_temperature(
+                    bin_shifted, accuracies, sample_confidences, in_bin, candidates, ece_criterion.bin_boundaries)
+                if acc_check:
+                    best_T = None
+                    for temp, after_temperature_ece, temp_accuracy in zip(
+                            *torch.stack([candidates, candidate_eces, candidate_accs]).tolist()):
+                        if bece_val > after_temperature_ece + eps and temp_accuracy >= accuracy:
+                            best_T = temp
+                            bece_val = after_temperature_ece
+                            accuracy = temp_accuracy
+                    bin_T = T_opt_bece[in_bin[:1], 0] if best_T is None else candidates.new_full((1,), best_T)
+                else:
+                    taken, bece_val = eps_scan(candidate_eces, bece_val, eps)
+                    bin_T = torch.where(taken.ge(0), candidates[taken.clamp(min=0)], T_opt_bece[in_bin[:1], 0])
+                T_opt_bece[in_bin] = bin_T
+                T_bece[in_bin] = bin_T
+                sample_confidences[in_bin] = scaled_softmax_max(bin_shifted, bin_T)
+                #self.bins_T[bin] = bins_T_opt[bin]
+                self.bins_T[bin] = bin_T[0]
             self.bece_temperature = T_opt_bece
             #self.bins_T = bins_T_opt
-            self.ece_list.append(ece_criterion(self.bins_temperature_scale(logits), labels).item())
-            converged = torch.all(self.bece_temperature.eq(prev_temperatures))
-            prev_temperatures = self.bece_temperature.clone()
+            self.ece_list.append(ece_score(sample_confidences, accuracies, ece_criterion.bin_boundaries).item())
+            converged = torch.equal(self.bece_temperature, prev_temperatures)
+            prev_temperatures.copy_(self.bece_temperature)
             
         self.bece_temperature = T_opt_bece
         #self.bins_T = bins_T_opt
-        self.cuda()
         
         return self
     
     def histedges_equalN(self, x):
-        npt = len(x)
-        return np.interp(np.linspace(0, npt, self.n_bins + 1),
-                     np.arange(npt),
-                     np.sort(x))
+        return equal_mass_bin_edges(x, self.n_bins)
     
+    @inference_mode()
     def set_bins_temperature2(self, valid_loader, cross_validate='ece', init_temp=2.5, acc_check=False, top_temp=10):
         """
         Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL
         """
         self.cuda()
         self.model.eval()
-        nll_criterion = nn.CrossEntropyLoss().cuda()
         ece_criterion = ECELoss().cuda()
 
         # First: collect all the logits and labels for the validation set
-        logits_list = []
-        labels_list = []
-        with torch.no_grad():
-            for input, label in valid_loader:
-                input = input.cuda()
-                logits = self.model(input)
-                logits_list.append(logits)
-                labels_list.append(label)
-            logits = torch.cat(logits_list).cuda()
-            labels = torch.cat(labels_list).cuda()
+        logits, labels = self.get_valid_logits(valid_loader)
 
         # Calculate NLL and ECE before temperature scaling
-        before_temperature_nll = nll_criterion(logits, labels).item()
-        before_temperature_ece = ece_criterion(logits, labels).item()
         if self.log:
+            before_temperature_nll, before_temperature_ece = torch.cat(
+                nll_ece(logits, labels, ece_criterion.bin_boundaries)).tolist()
             print('Before temperature - NLL: %.3f, ECE: %.3f' % (before_temperature_nll, before_temperature_ece))
             
         n_bins = self.n_bins
         eps = 1e-6
-        ece_val = 10 ** 7
-        T_opt_ece = 1.0
-        T = 0.1
-        for i in range(100):
-            self.temperature = T
-            self.cuda()
-            after_temperature_ece = ece_criterion(self.temperature_scale(logits), labels).item()
-            if ece_val > after_temperature_ece:
-                T_opt_ece = T
-                ece_val = after_temperature_ece
-            T += 0.1
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        T_opt_ece = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                       coarse=self.coarse_search, dtype=self.search_dtype,
+                                       patience=self.early_stop)
 
         init_temp = T_opt_ece
         self.temperature = T_opt_ece
@@ -511,38 +466,59 @@ class ModelWithTemperature(nn.Module):
             print('Optimal temperature: %.3f' % init_temp)
             print('After temperature - ECE: %.3f' % (after_temperature_ece))
 
-        init_temp = 1
-        T_opt_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-        T_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-        self.bins_T = init_temp*torch.ones((n_bins, self.iters)).cuda()
+        init_temp = 1.0
+        T_opt_bece = torch.full((logits.shape[0], 1), init_temp, device=logits.device)
+        T_bece = torch.full((logits.shape[0], 1), init_temp, device=logits.device)
+        self.bins_T = torch.full((n_bins, self.iters), init_temp, device=logits.device)
+        bin_temperatures = torch.tensor(temperatures, device=logits.device)
         self.bece_temperature = T_bece
         
-        self.ece_list.append(ece_criterion(self.temperature_scale(logits), labels).item())
+        self.ece_list.append(after_temperature_ece)
                 
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
+        # Positive temperatures keep the top class of every sample, so the accuracies are found once
+        confidences, predictions = torch.max(F.softmax(logits, dim=1), 1)
         accuracies = predictions.eq(labels)
                         
         for i in range(self.iters):
             ece_in_iter = 0
             print('iter num ', i+1)
-            bin = 0
             few_examples = dict()
             starts = dict()
-            n, self.bin_boundaries[i] = np.histogram(confidences.cpu().detach(), self.histedges_equalN(confidences.cpu().detach()))
-            bin_lowers = self.bin_boundaries[i][:-1]
-            bin_uppers = self.bin_boundaries[i][1:]
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
+            # One sort gives the equal-mass bins, the samples of a bin being a slice of the order
+            self.bin_boundaries[i], bin_idx, order, counts = equal_mass_bin_order(confidences, n_bins)
+            bin_counts = counts.tolist()
+            # Mean confidence of every searched bin for all candidates
+            searched = counts.ge(20)
+            bin_accuracies = torch.bincount(bin_idx, weights=accuracies.float(), minlength=n_bins + 1)[:n_bins] / counts.float()
+            bin_accuracies = torch.clamp(bin_accuracies, 0.01, 0.99)
+            sweep_logits, sweep_bin_idx = logits, bin_idx
+            if sum(samples for samples in bin_counts if samples >= 20) < logits.shape[0]:
+                swept = torch.cat([searched, searched.new_zeros(1)])[bin_idx]
+                sweep_logits, sweep_bin_idx = logits[swept], bin_idx[swept]
+            if self.bisect:
+                # Every searched bin solves for the temperature matching its accuracy, the only candidate of its scan
+                solved, bin_confidences = solve_bins_temperature(sweep_logits, bin_accuracies, sweep_bin_idx, n_bins,
+                                                                 dtype=self.search_dtype)
+                bin_candidates = [[T] if samples >= 20 else [] for T, samples in zip(solved.tolist(), bin_counts)]
+                bin_errors = torch.abs(bin_accuracies - bin_confidences).unsqueeze(1)
+            else:
+                bin_candidates = [temperatures] * n_bins
+                bin_confidences = bins_mean_confidences(sweep_logits, sweep_bin_idx, n_bins, bin_temperatures,
+                                                        dtype=self.search_dtype)
+                bin_errors = torch.abs(bin_accuracies.unsqueeze(1) - bin_confidences)
+            # |acc - conf| of every bin for all candidates
+            bin_errors, bin_errors_eps = torch.stack([bin_errors, bin_errors + eps]).tolist()
+            start = 0
+            for bin, samples in enumerate(bin_counts):
                 bece_val = 10 ** 7
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if confidences[in_bin].shape[0] < 20:
-                    samples = T_bece[in_bin].shape[0]
+                in_bin = order[start:start + samples]
+                start += samples
+                prop_in_bin = samples / confidences.shape[0]
+                if samples < 20:
                     print('number of samples in bin {0}: {1}'.format(bin + 1, samples))
                     few_examples[bin] = samples
-                    bin += 1
                     continue
-                if any(in_bin):
+                if samples > 0:
                     """
                     if confidences[in_bin].shape[0] < 10 and bin > 0 and bin < n_bins - 1:
                         avg_temp = (self.bins_T[bin - 1, i] + self.bins_T[bin + 1, i]) / 2  # Mean temperature of neighbors
@@ -563,72 +539,30 @@ class ModelWithTemperature(nn.Module):
                         bin += 1
                         continue
                     """
-                    init_temp_value = T_bece[in_bin][0].item()
-                    T = 0.1
-                    accuracies_temp = accuracies[in_bin]
-                    accuracy_in_bin = min(accuracies_temp.float().mean().item(), 0.99)
-                    accuracy_in_bin = max(accuracy_in_bin, 0.01)
-                    for t in range(100):
-                        T_bece[in_bin] = T
-                        self.bece_temperature = T_bece
-                        
-                        softmaxes_temp = F.softmax(logits[in_bin] / torch.unsqueeze(T_bece[in_bin], -1), dim=1)
-                        confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                        """
-                        if accuracy_in_bin == 0:
-                            T_opt_bece[in_bin] = top_temp
-                            softmaxes_temp = F.softmax(logits[in_bin] / top_temp, dim=1)
-                            confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                            avg_confidence_in_bin = confidences_temp.mean()
-                            bece_val = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                            break
-                        """
-                        avg_confidence_in_bin = confidences_temp.mean()
-                        after_temperature = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                        
-                        if bece_val > after_temperature + eps:
-                            T_opt_bece[in_bin] = T
+                    # The same eps-improvement scan over the bin's candidates
+                    best_T = None
+                    for T, after_temperature, after_temperature_eps in zip(
+                            bin_candidates[bin], bin_errors[bin], bin_errors_eps[bin]):
+                        if bece_val > after_temperature_eps:
+                            best_T = T
                             bece_val = after_temperature
-                            #print('conf-acc: ', (avg_confidence_in_bin - accuracy_in_bin).item())
-                            #print('temp: ', T)
-                        T += 0.1
-                        
+                    if best_T is not None:
+                        T_opt_bece[in_bin] = best_T
+
                     T_bece[in_bin] = T_opt_bece[in_bin]
-                    self.bins_T[bin, i] = T_opt_bece[in_bin][0].item()
+                    self.bins_T[bin, i] = T_opt_bece[in_bin[0], 0]
                     
-                    samples = T_bece[in_bin].shape[0]
                     ece_in_iter += prop_in_bin * bece_val
-                    print('ece in bin ', bin+1, ' :', (prop_in_bin * bece_val).item(), ', number of samples: ', samples)
-                bin += 1
-
-            for bin in few_examples:
-                #bins_T[bin, i] = self.temperature
-
-                if bin > 0 and bin < n_bins - 1:
-                    lower_bin = bin - 1
-                    upper_bin = bin + 1
-                    while lower_bin in few_examples and lower_bin - 1 >= 0:
-                        lower_bin -= 1
-                    while upper_bin in few_examples and upper_bin + 1 <= n_bins - 1:
-                        upper_bin += 1
-                    if upper_bin == n_bins - 1:
-                        self.bins_T[bin, i] = self.bins_T[lower_bin, i]
-                    else:
-                        avg_temp = (self.bins_T[lower_bin, i] + self.bins_T[upper_bin, i]) / 2  # Mean temperature of neighbors
-                        self.bins_T[bin, i] = avg_temp
-                elif bin == 0:
-                    upper_bin = bin + 1
-                    while upper_bin in few_examples and upper_bin + 1 <= n_bins - 1:
-                        upper_bin += 1
-                    self.bins_T[bin, i] = self.bins_T[upper_bin, i]
-                else:
-                    lower_bin = bin - 1
-                    while lower_bin in few_examples and lower_bin - 1 >= 0:
-                        lower_bin -= 1
-                    self.bins_T[bin, i] = self.bins_T[lower_bin, i]
+                    print('ece in bin ', bin+1, ' :', prop_in_bin * bece_val, ', number of samples: ', samples)
+
+            if few_examples:
+                self.bins_T[:, i] = fill_few_bins(self.bins_T[:, i], list(few_examples))
             
             self.bece_temperature = T_opt_bece
-            current_ece = ece_criterion(self.bins_temperature_scale(logits), labels).item()
+            # The scaled confidences give both this iteration's ECE and the next iteration's bins
+            scaled_logits = self.bins_temperature_scale(logits)
+            scaled_confidences = torch.max(F.softmax(scaled_logits, dim=1), 1)[0]
+            current_ece = ece_score(scaled_confidences, accuracies, ece_criterion.bin_boundaries).item()
             print('ece in iter ', i + 1, ' :', current_ece)
             if i > 0 and current_ece < self.ece_list[self.best_iter]:
                 self.best_iter = i
@@ -638,9 +572,8 @@ class ModelWithTemperature(nn.Module):
                 self.iters = i + 1
                 break
             
-            logits = logits / torch.unsqueeze(self.bece_temperature, -1)
-            softmaxes = F.softmax(logits, dim=1)
-            confidences, predictions = torch.max(softmaxes, 1)
+            logits = scaled_logits
+            confidences = scaled_confidences
             
         self.bece_temperature = T_opt_bece
 
@@ -662,48 +595,518 @@ def class_temperature_scale2(logits, csece_temperature):
     return logits / csece_temperature
 
 
-        
+def temperature_grid(start, step, steps):
+    """
+    Candidate temperatures start, start + step, ..., each computed as start + i * step
+    so that the rounding does not accumulate along the grid
+    """
+    return (torch.arange(steps, dtype=torch.float64) * step + start).tolist()
+
+
+def sweep_temperatures(logits, labels, temperatures, bin_boundaries, dtype=None):
+    """
+    ECE and NLL of logits / T for every candidate row of temperatures ([K] or [K, C]),
+    evaluating as many candidates at once as fit in a bounded [k, N, C] buffer.
+    With dtype (e.g. torch.bfloat16) the ECE softmax runs in that precision; NLL and predictions stay in full precision
+    """
+    n_candidates = temperatures.shape[0]
+    chunk = max(1, (1 << 25) // logits.numel())
+    ece_list = []
+    nll_list = []
+    if temperatures.dim() == 1:
+        # A single T > 0 keeps the top class, so the accuracies and the max shift are taken once
+        # and every candidate only needs its [k, N] confidences and NLLs
+        max_logits, predictions = torch.max(logits, 1, keepdim=True)
+        accuracies = predictions.view(1, -1).eq(labels.view(1, -1))
+        shifted = logits - max_logits
+        label_logits = shifted.gather(1, labels.view(-1, 1)).view(-1)
+        for start in range(0, n_candidates, chunk):
+            T = temperatures[start:start + chunk]
+            if dtype is None:
+                confidences = candidates_softmax_max(shifted, T)
+            else:
+                confidences = 1.0 / torch.exp((shifted.unsqueeze(0) / T.view(-1, 1, 1)).to(dtype)).sum(dim=2, dtype=torch.float32)
+            conf_sum, acc_sum, _ = batched_bin_sums(confidences, accuracies.expand(T.shape[0], -1), bin_boundaries)
+            ece_list.append(torch.abs(conf_sum - acc_sum).sum(dim=1) / logits.shape[0])
+            nll_list.append(candidates_nll(shifted, label_logits, T).mean(dim=1))
+        return torch.cat(ece_list), torch.cat(nll_list)
+    for start in range(0, n_candidates, chunk):
+        T = temperatures[start:start + chunk]
+        scaled_logits = logits.unsqueeze(0) / T.view(T.shape[0], 1, -1)
+        if dtype is None:
+            softmaxes = F.softmax(scaled_logits, dim=2)
+            confidences, predictions = torch.max(softmaxes, 2)
+        else:
+            softmaxes = F.softmax(scaled_logits.to(dtype), dim=2)
+            confidences = torch.max(softmaxes, 2)[0].float()
+            predictions = torch.max(scaled_logits, 2)[1]
+        accuracies = predictions.eq(labels.unsqueeze(0))
+        conf_sum, acc_sum, _ = batched_bin_sums(confidences, accuracies, bin_boundaries)
+        ece_list.append(torch.abs(conf_sum - acc_sum).sum(dim=1) / logits.shape[0])
+        # -log p_y = logsumexp(z / T) - z_y / T, without the [k, N, C] log-softmax
+        label_logits = scaled_logits.gather(2, labels.view(1, -1, 1).expand(T.shape[0], -1, 1)).squeeze(2)
+        nll_list.append((torch.logsumexp(scaled_logits, dim=2) - label_logits).mean(dim=1))
+    return torch.cat(ece_list), torch.cat(nll_list)
+
+
+def bin_temperature_errors(logits, accuracy, temperatures, dtype=None):
+    """
+    |accuracy - mean confidence| of logits / T for every candidate T, in bounded [k, N, C] chunks.
+    With dtype the exponentials are taken in that precision and summed in float32
+    """
+    chunk = max(1, (1 << 25) // max(1, logits.numel()))
+    # The top class of logits / T does not depend on T, so its softmax is 1 / sum(exp((x - max) / T))
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    errors = []
+    for start in range(0, temperatures.shape[0], chunk):
+        T = temperatures[start:start + chunk]
+        if dtype is None:
+            confidences = candidates_softmax_max(shifted, T)
+        else:
+            confidences = 1.0 / torch.exp((shifted.unsqueeze(0) / T.view(-1, 1, 1)).to(dtype)).sum(dim=2, dtype=torch.float32)
+        errors.append(torch.abs(accuracy - confidences.mean(dim=1)))
+    return torch.cat(errors)
+
+
+def solve_bin_temperature(logits, accuracy, low=0.1, high=10.0, steps=20):
+    """
+    Temperature in [low, high] at which the mean top-class confidence of logits / T equals accuracy, by bisection.
+    The mean confidence decreases with T, so an end of the range is returned when it cannot be matched
+    """
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+
+    def mean_confidence(T):
+        return (1.0 / torch.exp(shifted / T).sum(dim=1)).mean().item()
+
+    if mean_confidence(low) <= accuracy:
+        return low
+    if mean_confidence(high) >= accuracy:
+        return high
+    for _ in range(steps):
+        mid = (low + high) / 2
+        if mean_confidence(mid) > accuracy:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def solve_bins_temperature(logits, accuracies, bin_idx, n_bins, low=0.1, high=10.0, steps=20, dtype=None):
+    """
+    solve_bin_temperature for all the bins together, every bisection step scoring the midpoints of all bins
+    in one pass over the samples. accuracies are the [n_bins] targets and bin_idx is bin_indices of the
+    samples. The temperatures and the mean confidences they give, both [n_bins]; empty bins give nan confidences.
+    dtype is as in bin_temperature_errors
+    """
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    count = torch.bincount(bin_idx, minlength=n_bins + 1)[:n_bins].float()
+
+    def mean_confidences(temperatures):
+        sample_temperatures = torch.cat([temperatures, temperatures.new_ones(1)])[bin_idx].float().unsqueeze(1)
+        if dtype is None:
+            confidences = 1.0 / torch.exp(shifted / sample_temperatures).sum(dim=1)
+        else:
+            confidences = 1.0 / torch.exp((shifted / sample_temperatures).to(dtype)).sum(dim=1, dtype=torch.float32)
+        return torch.bincount(bin_idx, weights=confidences, minlength=n_bins + 1)[:n_bins] / count
+
+    low, high = float(low), float(high)
+    lows = torch.full((n_bins,), low, dtype=torch.float64, device=logits.device)
+    highs = torch.full((n_bins,), high, dtype=torch.float64, device=logits.device)
+    at_low = mean_confidences(lows).le(accuracies)
+    at_high = mean_confidences(highs).ge(accuracies)
+    for _ in range(steps):
+        mids = (lows + highs) / 2
+        above = mean_confidences(mids).gt(accuracies)
+        lows = torch.where(above, mids, lows)
+        highs = torch.where(above, highs, mids)
+    temperatures = torch.where(at_low, lows.new_full((1,), low), torch.where(at_high, highs.new_full((1,), high), (lows + highs) / 2))
+    return temperatures, mean_confidences(temperatures)
+
+
+def bin_slices(bin_idx, n_bins):
+    """
+    The samples sorted by bin, in their original order within every bin, and the sizes of the
+    n_bins + 1 slices of that order (the last one holding the out-of-range samples)
+    """
+    keys = bin_idx * bin_idx.shape[0] + torch.arange(bin_idx.shape[0], device=bin_idx.device)
+    return torch.sort(keys)[1], torch.bincount(bin_idx, minlength=n_bins + 1).tolist()
+
+
+def bin_means(values, order, sizes):
+    """
+    Mean of the [K, N] per-sample values over the samples of every bin ([K, n_bins]), from bin_slices.
+    Every bin takes its own mean, as the scans over a single bin's samples did: one index_add over all
+    the bins rounds differently, and the strict improvement scans turn that into different picks
+    """
+    binned = values[:, order].split(sizes, dim=1)[:-1]
+    return torch.stack([bin_values.contiguous().mean(dim=1) for bin_values in binned], 1)
+
+
+def bins_mean_confidences(logits, bin_idx, n_bins, temperatures, dtype=None):
+    """
+    Mean top-class confidence of the logits / T of every bin ([n_bins, K]), all the bins from one sweep over
+    the samples in bounded [k, N, C] chunks. bin_idx is bin_indices of the samples, empty bins give nan.
+    dtype is as in bin_temperature_errors
+    """
+    chunk = max(1, (1 << 25) // max(1, logits.numel()))
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    order, sizes = bin_slices(bin_idx, n_bins)
+    conf_means = []
+    for start in range(0, temperatures.shape[0], chunk):
+        T = temperatures[start:start + chunk]
+        if dtype is None:
+            confidences = candidates_softmax_max(shifted, T)
+        else:
+            confidences = 1.0 / torch.exp((shifted.unsqueeze(0) / T.view(-1, 1, 1)).to(dtype)).sum(dim=2, dtype=torch.float32)
+        conf_means.append(bin_means(confidences, order, sizes))
+    return torch.cat(conf_means).t()
+
+
+def bins_temperature_nlls(logits, labels, bin_idx, n_bins, temperatures):
+    """
+    NLL of the logits / T of every bin ([n_bins, K]), all the bins from one sweep over the samples
+    in bounded [k, N, C] chunks. bin_idx is bin_indices of the samples, empty bins give nan.
+    Always in float32: in bfloat16 the exponentials move the chosen bin temperatures by up to ~10
+    """
+    chunk = max(1, (1 << 25) // max(1, logits.numel()))
+    order, sizes = bin_slices(bin_idx, n_bins)
+    # The max shift of log_softmax does not depend on T > 0, so it is taken once with the label logits
+    shifted = logits - torch.max(logits, 1, keepdim=True)[0]
+    label_logits = shifted.gather(1, labels.view(-1, 1)).view(-1)
+    nll_means = []
+    for start in range(0, temperatures.shape[0], chunk):
+        T = temperatures[start:start + chunk]
+        nlls = candidates_nll(shifted, label_logits, T)
+        nll_means.append(bin_means(nlls, order, sizes))
+    return torch.cat(nll_means).t()
+
+
+def sweep_model_temperatures(logits, labels, temperatures, bin_boundaries):
+    """
+    sweep_temperatures for the [M, N, C] logits of M models on the same samples: ECE and NLL are [M, K]
+    """
+    n_models, n = logits.shape[0], logits.shape[1]
+    chunk = max(1, (1 << 25) // logits.numel())
+    ece_list = []
+    nll_list = []
+    for start in range(0, temperatures.shape[0], chunk):
+        T = temperatures[start:start + chunk]
+        k = T.shape[0]
+        scaled_logits = logits.unsqueeze(1) / T.view(1, k, 1, 1)
+        softmaxes = F.softmax(scaled_logits, dim=3)
+        confidences, predictions = torch.max(softmaxes, 3)
+        accuracies = predictions.eq(labels.view(1, 1, -1))
+        conf_sum, acc_sum, _ = batched_bin_sums(confidences.reshape(-1, n), accuracies.reshape(-1, n), bin_boundaries)
+        ece_list.append((torch.abs(conf_sum - acc_sum).sum(dim=1) / n).view(n_models, k))
+        label_logits = scaled_logits.gather(3, labels.view(1, 1, -1, 1).expand(n_models, k, -1, 1)).squeeze(3)
+        nll_list.append((torch.logsumexp(scaled_logits, dim=3) - label_logits).mean(dim=2))
+    return torch.cat(ece_list, dim=1), torch.cat(nll_list, dim=1)
+
+
+def coarse_window(coarse_vals, coarse_step, n_candidates):
+    """
+    Slice of the candidates between the neighbours of the minimum of coarse_vals, the values of every
+    coarse_step-th candidate; all candidates if the coarse curve is not unimodal
+    """
+    k = coarse_vals.index(min(coarse_vals))
+    decreasing = all(a >= b for a, b in zip(coarse_vals[:k], coarse_vals[1:k + 1]))
+    increasing = all(a <= b for a, b in zip(coarse_vals[k:], coarse_vals[k + 1:]))
+    if not (decreasing and increasing):
+        return slice(0, n_candidates)
+    lower = max(k - 1, 0) * coarse_step
+    upper = (k + 1) * coarse_step if k + 1 < len(coarse_vals) else n_candidates - 1
+    return slice(lower, upper + 1)
+
+
+def warm_window(temperature, start, step, n_candidates, radius=5):
+    """
+    Slice of the temperature_grid(start, step, n_candidates) candidates within radius steps of temperature
+    """
+    k = int(round((temperature - start) / step))
+    return slice(min(max(k - radius, 0), n_candidates - 1), min(max(k + radius + 1, 1), n_candidates))
+
+
+def search_temperature(logits, labels, temperatures, bin_boundaries, cross_validate='ece', coarse=False, coarse_step=10,
+                       dtype=None, patience=None, tol=1e-4):
+    """
+    First candidate temperature minimizing the ECE (or the NLL) of logits / T.
+    With coarse, every coarse_step-th candidate is scored first and only the candidates between the
+    neighbours of the coarse minimum are then scored; all of them are scored if the coarse curve is not unimodal.
+    With patience, candidates are scored in chunks of 10 and the search stops after patience candidates
+    in a row did not improve on the best value by more than tol
+    """
+    candidates = list(range(len(temperatures)))
+    if coarse:
+        coarse_ece, coarse_nll = sweep_temperatures(
+            logits, labels, torch.tensor(temperatures[::coarse_step], device=logits.device), bin_boundaries, dtype=dtype)
+        coarse_vals = (coarse_ece if cross_validate == 'ece' else coarse_nll).tolist()
+        candidates = candidates[coarse_window(coarse_vals, coarse_step, len(temperatures))]
+    candidate_temperatures = torch.tensor([temperatures[i] for i in candidates], device=logits.device)
+    if patience is None:
+        after_temperature_ece, after_temperature_nll = sweep_temperatures(
+            logits, labels, candidate_temperatures, bin_boundaries, dtype=dtype)
+        vals = after_temperature_ece if cross_validate == 'ece' else after_temperature_nll
+        return temperatures[candidates[torch.argmin(vals).item()]]
+
+    best_val = float('inf')
+    best_idx = 0
+    ref_val = float('inf')
+    stale = 0
+    for start in range(0, len(candidates), 10):
+        after_temperature_ece, after_temperature_nll = sweep_temperatures(
+            logits, labels, candidate_temperatures[start:start + 10], bin_boundaries, dtype=dtype)
+        vals = after_temperature_ece if cross_validate == 'ece' else after_temperature_nll
+        for i, val in enumerate(vals.tolist()):
+            if val < best_val:
+                best_val = val
+                best_idx = start + i
+            # Only improvements larger than tol reset the patience
+            if val < ref_val - tol:
+                ref_val = val
+                stale = 0
+            else:
+                stale += 1
+        if stale >= patience:
+            break
+    return temperatures[candidates[best_idx]]
+
+
+def sweep_bin_temperature(bin_shifted, accuracies, confidences, in_bin, temperatures, bin_boundaries):
+    """
+    ECE and accuracy of the samples' current top-class confidences when the samples in in_bin, whose
+    max-shifted logits are bin_shifted, take each candidate temperature. A per-sample T > 0 keeps the
+    predictions, so the accuracies are fixed and only the rows of in_bin are re-scored per candidate;
+    the other rows enter the bin sums once
+    """
+    rest_conf_sum, rest_acc_sum, _ = bin_sums(confidences.index_fill(0, in_bin, 0),
+                                              accuracies.index_fill(0, in_bin, False), bin_boundaries)
+    bin_confidences = candidates_softmax_max(bin_shifted, temperatures)
+    conf_sum, acc_sum, _ = batched_bin_sums(bin_confidences, accuracies[in_bin].expand(temperatures.shape[0], -1),
+                                            bin_boundaries)
+    eces = torch.abs(conf_sum + rest_conf_sum - acc_sum - rest_acc_sum).sum(dim=1) / confidences.shape[0]
+    return eces, accuracies.float().mean().expand(temperatures.shape[0])
+
+
+@torch.jit.script
+def eps_scan(vals, best_val, eps: float):
+    """
+    Device form of the host scans over candidates: vals are walked in order and every value below the running
+    best_val by more than eps is taken. The index of the last value taken (-1 if none) and the running best,
+    both left on the device
+    """
+    taken = torch.full_like(best_val, -1, dtype=torch.long)
+    for k in range(vals.shape[0]):
+        better = best_val > vals[k] + eps
+        best_val = torch.where(better, vals[k], best_val)
+        taken = torch.where(better, torch.full_like(taken, k), taken)
+    return taken, best_val
+
+
+def bin_indices(confidences, bin_boundaries):
+    """
+    (lower, upper] bin of every confidence from one bucketize, n_bins for the confidences out of range
+    """
+    n_bins = bin_boundaries.shape[0] - 1
+    in_range = confidences.gt(bin_boundaries[0]) & confidences.le(bin_boundaries[-1])
+    bin_idx = torch.bucketize(confidences, bin_boundaries[1:-1])
+    return torch.where(in_range, bin_idx, torch.full_like(bin_idx, n_bins))
+
+
+def bin_order(confidences, bin_boundaries):
+    """
+    (lower, upper] bin of every confidence (n_bins when out of range), the samples sorted by bin and
+    the number of samples in every bin, so that the samples of a bin are a slice of the order
+    """
+    n_bins = bin_boundaries.shape[0] - 1
+    bin_idx = bin_indices(confidences, bin_boundaries)
+    # Unique keys keep the samples of a bin in their original order without sort(stable=True)
+    keys = bin_idx * confidences.shape[0] + torch.arange(confidences.shape[0], device=confidences.device)
+    order = torch.sort(keys)[1]
+    counts = torch.bincount(bin_idx, minlength=n_bins + 1)[:n_bins]
+    return bin_idx, order, counts
+
+
+def equal_mass_bin_order(confidences, n_bins):
+    """
+    equal_mass_bin_edges of the confidences and bin_order over them from a single sort. The bins are
+    intervals, so the confidence order lists them one after the other, only led by the samples on the
+    lowest edge, which are in no bin and are moved to the end of the order
+    """
+    sorted_confidences, sorted_order = torch.sort(confidences)
+    bin_boundaries = equal_mass_bin_edges(sorted_confidences, n_bins, True)
+    bin_idx = bin_indices(confidences, bin_boundaries)
+    counts = torch.bincount(bin_idx, minlength=n_bins + 1)
+    positions = torch.arange(confidences.shape[0], device=confidences.device)
+    order = sorted_order[(positions + counts[n_bins]) % confidences.shape[0]]
+    return bin_boundaries, bin_idx, order, counts[:n_bins]
+
+
+def fill_few_bins(bins_T, few_bins):
+    """
+    Temperatures of the bins with too few samples taken from their nearest valid neighbours:
+    the mean of both for inner bins (only the lower one when the upper walk reaches the last bin),
+    the single neighbour for the first and last bins
+    """
+    n_bins = bins_T.shape[0]
+    few = torch.zeros(n_bins, dtype=torch.bool, device=bins_T.device)
+    few[few_bins] = True
+    bin_idx = torch.arange(n_bins, device=bins_T.device)
+    # The nearest valid bins below and above every bin from a forward and a backward running extremum
+    lower = torch.where(few, torch.full_like(bin_idx, -1), bin_idx).cummax(0)[0].clamp(min=0)
+    upper = torch.where(few, torch.full_like(bin_idx, n_bins), bin_idx).flip(0).cummin(0)[0].flip(0).clamp(max=n_bins - 1)
+    # The first bin is filled before the others, which may read it as their lower neighbour
+    if 0 in few_bins:
+        bins_T = torch.cat([bins_T[upper[:1]], bins_T[1:]])
+    inner = few.clone()
+    inner[0] = False
+    inner[-1] = False
+    avg_temp = torch.where(upper.eq(n_bins - 1), bins_T[lower], (bins_T[lower] + bins_T[upper]) / 2)
+    bins_T = torch.where(inner, avg_temp, bins_T)
+    if n_bins - 1 in few_bins:
+        bins_T = torch.cat([bins_T[:-1], bins_T[lower[-1:]]])
+    return bins_T
+
+
+def sweep_class_temperature(logits, scaled_logits, label, temperatures, labels, bin_boundaries):
+    """
+    ECE and accuracy of scaled_logits for every candidate temperature of a single class column.
+    The other columns are reduced once to their max and logsumexp, so each candidate costs O(N)
+    instead of a full softmax over the [N, C] logits
+    """
+    eces, accs = sweep_classes_temperature(logits, scaled_logits, torch.tensor([label], device=logits.device),
+                                           temperatures, labels, bin_boundaries)
+    return eces[0], accs[0]
+
+
+@torch.jit.script
+def sweep_classes_temperature(logits, scaled_logits, classes, temperatures, labels, bin_boundaries):
+    """
+    sweep_class_temperature for each of the classes with the other columns of scaled_logits held fixed,
+    in bounded chunks of classes. The K candidates are shared ([K]) or per class ([len(classes), K]),
+    the ECE and accuracy are [len(classes), K]
+    """
+    n, c = logits.shape
+    chunk = max(1, (1 << 25) // (n * max(c, temperatures.shape[-1])))
+    ece_list = []
+    acc_list = []
+    for start in range(0, classes.shape[0], chunk):
+        cls = classes[start:start + chunk].view(-1, 1, 1)
+        other_logits = scaled_logits.unsqueeze(0).masked_fill(torch.arange(c, device=logits.device).view(1, 1, -1).eq(cls),
+                                                              float('-inf'))
+        other_max, other_predictions = torch.max(other_logits, 2, keepdim=True)
+        other_max = other_max.transpose(1, 2)
+        other_predictions = other_predictions.transpose(1, 2)
+        other_lse = torch.logsumexp(other_logits, 2).unsqueeze(1)
+        if temperatures.dim() == 1:
+            class_temperatures = temperatures.view(1, -1, 1)
+        else:
+            class_temperatures = temperatures[start:start + chunk].unsqueeze(2)
+        column = logits[:, cls.view(-1)].t().unsqueeze(1) / class_temperatures
+        # torch.max keeps the first index on ties
+        wins = column.gt(other_max) | (column.eq(other_max) & other_predictions.gt(cls))
+        confidences = torch.exp(torch.max(column, other_max) - torch.logaddexp(column, other_lse))
+        predictions = torch.where(wins, cls.expand_as(column), other_predictions.expand_as(column))
+        accuracies = predictions.eq(labels)
+        conf_sum, acc_sum, _ = batched_bin_sums(confidences.reshape(-1, n), accuracies.reshape(-1, n), bin_boundaries)
+        ece_list.append((torch.abs(conf_sum - acc_sum).sum(dim=1) / n).view(cls.shape[0], -1))
+        acc_list.append(accuracies.float().mean(dim=2))
+    return torch.cat(ece_list), torch.cat(acc_list)
+
+
+@torch.jit.script
+def class_temperatures_pass(logits, scaled_logits, class_temperatures, csece_val, temp_steps, labels, bin_boundaries,
+                            relative: bool = True):
+    """
+    One coordinate descent pass over the class temperatures of set_temperature: every class in turn moves
+    by the step offset with the lowest ECE if it improves on csece_val. Scripted, and csece_val is a [1] device
+    tensor, so the pass runs without the interpreter or a sync between the classes. class_temperatures and
+    scaled_logits are updated in place.
+    Without relative, temp_steps are the candidate temperatures themselves, as in set_temperature2
+    """
+    for label in range(logits.shape[1]):
+        candidates = class_temperatures[label] + temp_steps if relative else temp_steps
+        candidate_eces, _ = sweep_classes_temperature(logits, scaled_logits, torch.tensor([label], device=logits.device),
+                                                      candidates, labels, bin_boundaries)
+        best = torch.argmin(candidate_eces[0]).view(1)
+        improved = candidate_eces[0, best] < csece_val
+        csece_val = torch.where(improved, candidate_eces[0, best], csece_val)
+        class_temperatures[label:label + 1] = torch.where(improved, candidates[best], class_temperatures[label:label + 1])
+        scaled_logits[:, label] = logits[:, label] / class_temperatures[label]
+    return csece_val
+
+
+@torch.jit.script
+def golden_class_temperatures_pass(logits, scaled_logits, class_temperatures, csece_val, labels, bin_boundaries,
+                                   low: float = 0.1, high: float = 10.0, steps: int = 15):
+    """
+    class_temperatures_pass with a golden-section search of every class temperature in [low, high] instead of
+    a grid: steps + 2 candidates per class, each step keeping the part of the range around the lower of its two
+    inner points. A class moves to the best candidate it tried if that improves on csece_val. The ECE is not
+    guaranteed to be unimodal in a class temperature, so this can settle away from the best grid candidate
+    """
+    ratio = (5 ** 0.5 - 1) / 2
+    for label in range(logits.shape[1]):
+        classes = torch.tensor([label], device=logits.device)
+        lows = torch.full((1,), low, device=logits.device)
+        highs = torch.full((1,), high, device=logits.device)
+        inner = torch.cat([highs - ratio * (highs - lows), lows + ratio * (highs - lows)])
+        inner_eces = sweep_classes_temperature(logits, scaled_logits, classes, inner, labels, bin_boundaries)[0][0]
+        best = torch.argmin(inner_eces).view(1)
+        best_T, best_ece = inner[best], inner_eces[best]
+        for _ in range(steps):
+            # The lower inner point stays inner, the new one is placed symmetrically to it
+            left = inner_eces[:1] < inner_eces[1:]
+            lows = torch.where(left, lows, inner[:1])
+            highs = torch.where(left, inner[1:], highs)
+            new_T = torch.where(left, highs - ratio * (highs - lows), lows + ratio * (highs - lows))
+            new_ece = sweep_classes_temperature(logits, scaled_logits, classes, new_T, labels, bin_boundaries)[0][0]
+            kept_T = torch.where(left, inner[:1], inner[1:])
+            kept_ece = torch.where(left, inner_eces[:1], inner_eces[1:])
+            inner = torch.where(left, torch.cat([new_T, kept_T]), torch.cat([kept_T, new_T]))
+            inner_eces = torch.where(left, torch.cat([new_ece, kept_ece]), torch.cat([kept_ece, new_ece]))
+            better = new_ece < best_ece
+            best_T = torch.where(better, new_T, best_T)
+            best_ece = torch.where(better, new_ece, best_ece)
+        improved = best_ece < csece_val
+        csece_val = torch.where(improved, best_ece, csece_val)
+        class_temperatures[label:label + 1] = torch.where(improved, best_T, class_temperatures[label:label + 1])
+        scaled_logits[:, label] = logits[:, label] / class_temperatures[label]
+    return csece_val
+
+
+@inference_mode()
 def set_temperature2(logits, labels, iters=1, cross_validate='ece',
-                     init_temp=2.5, acc_check=False, const_temp=False, log=True, num_bins=25):
+                     init_temp=2.5, acc_check=False, const_temp=False, log=True, num_bins=25, coarse=False, stats=None,
+                     jacobi=False, dtype=None, warm_start=False, patience=None, golden=False, search_device=None):
     """
-    Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL
+    Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL.
+    coarse: search every temperature grid coarse-to-fine. patience: stop the single temperature search early.
+    jacobi: sweep all the classes of an iteration against its start temperatures. dtype: softmax precision of
+    the single temperature sweep. warm_start: later iterations only try candidates within 0.5 of each class.
+    golden: golden-section search of each class temperature. search_device: device of the class searches.
+    stats is softmax_stats(logits, labels), computed here when not given
     """
+    if stats is None:
+        stats = softmax_stats(logits, labels)
+    softmaxes, log_softmaxes, confidences, predictions, accuracies = stats
+    probs = (softmaxes, confidences, predictions, accuracies, labels)
     if const_temp:
-        nll_criterion = nn.CrossEntropyLoss().cuda()
         ece_criterion = ECELoss().cuda()
 
         # Calculate NLL and ECE before temperature scaling
-        before_temperature_nll = nll_criterion(logits, labels).item()
-        before_temperature_ece = ece_criterion(logits, labels).item()
+        before_temperature_nll = F.nll_loss(log_softmaxes, labels).item()
+        before_temperature_ece = ece_criterion.forward_from_probs(*probs).item()
         if log:
             print('Before temperature - NLL: %.3f, ECE: %.3f' % (before_temperature_nll, before_temperature_ece))
 
-        nll_val = 10 ** 7
-        ece_val = 10 ** 7
-        T_opt_nll = 1.0
-        T_opt_ece = 1.0
-        T = 0.1
-        for i in range(100):
-            temperature = T
-            after_temperature_nll = nll_criterion(temperature_scale2(logits, temperature), labels).item()
-            after_temperature_ece = ece_criterion(temperature_scale2(logits, temperature), labels).item()
-            if nll_val > after_temperature_nll:
-                T_opt_nll = T
-                nll_val = after_temperature_nll
-
-            if ece_val > after_temperature_ece:
-                T_opt_ece = T
-                ece_val = after_temperature_ece
-            T += 0.1
-
-        if cross_validate == 'ece':
-            temperature = T_opt_ece
-        else:
-            temperature = T_opt_nll
+        # All 100 candidates T = 0.1, 0.2, ..., 10 in one batched sweep
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        temperature = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                         cross_validate=cross_validate, coarse=coarse, dtype=dtype, patience=patience)
 
         # Calculate NLL and ECE after temperature scaling
-        after_temperature_nll = nll_criterion(temperature_scale2(logits, temperature), labels).item()
-        after_temperature_ece = ece_criterion(temperature_scale2(logits, temperature), labels).item()
+        after_temperature_nll, after_temperature_ece = torch.cat(
+            nll_ece(temperature_scale2(logits, temperature), labels, ece_criterion.bin_boundaries)).tolist()
         if log:
             print('Optimal temperature: %.3f' % temperature)
             print('After temperature - NLL: %.3f, ECE: %.3f' % (after_temperature_nll, after_temperature_ece))
@@ -714,21 +1117,13 @@ def set_temperature2(logits, labels, iters=1, cross_validate='ece',
         """
         # Calculate ECE before temperature scaling
         ece_criterion = ECELoss(n_bins=num_bins).cuda()
-        before_temperature_ece = ece_criterion(logits, labels).item()
+        before_temperature_ece = ece_criterion.forward_from_probs(*probs).item()
         if log:
             print('Before temperature - ECE: %.3f' % (before_temperature_ece))
 
-        ece_val = 10 ** 7
-        T_opt_ece = 1.0
-        T = 0.1
-        for i in range(100):
-            temperature = T
-            after_temperature_ece = ece_criterion(temperature_scale2(logits, temperature), labels).item()
-            
-            if ece_val > after_temperature_ece:
-                T_opt_ece = T
-                ece_val = after_temperature_ece
-            T += 0.1
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        T_opt_ece = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries, coarse=coarse,
+                                       dtype=dtype, patience=patience)
 
         init_temp = T_opt_ece
 
@@ -744,8 +1139,6 @@ def set_temperature2(logits, labels, iters=1, cross_validate='ece',
         #ece_criterion = estECELoss(n_bins=num_bins).cuda()
         ece_list = []
         
-        # Calculate NLL and ECE before temperature scaling
-        before_temperature_ece = ece_criterion(logits, labels).item()
         """
         softmaxs = softmax(logits)
         preds = np.argmax(softmaxs, axis=1)
@@ -753,90 +1146,88 @@ def set_temperature2(logits, labels, iters=1, cross_validate='ece',
         before_temperature_ece = ECE(confs, preds, labels, bin_size = 1/num_bins)
         """
         if acc_check:
-            _, accuracy, _, _, _ = test_classification_net_logits(logits, labels)
+            _, accuracy, _, _, _ = test_classification_net_probs(confidences, predictions, labels)
 
         if log:
             print('Before temperature - ECE: {0:.3f}'.format(before_temperature_ece))
 
-        T_opt_nll = 1.0
-        T_opt_ece = 1.0
-        T_opt_csece = init_temp*torch.ones(logits.size()[1]).cuda()
-        T_csece = init_temp*torch.ones(logits.size()[1]).cuda()
-        csece_temperature = T_csece
-        """
-        softmaxs = softmax(class_temperature_scale2(logits, csece_temperature))
-        preds = np.argmax(softmaxs, axis=1)
-        confs = np.max(softmaxs, axis=1)
-        ece_list.append(ECE(confs, preds, labels, bin_size = 1/num_bins))
-        """
-        ece_list.append(ece_criterion(class_temperature_scale2(logits, csece_temperature), labels).item())
+        device = logits.device
+        if search_device is not None and logits.is_cuda and torch.device(search_device).type == 'cpu':
+            # Copied into pinned memory without blocking, then synchronized once
+            logits, labels = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True).copy_(t, non_blocking=True)
+                              for t in (logits, labels)]
+            torch.cuda.current_stream(device).synchronize()
+        elif search_device is not None:
+            logits, labels = logits.to(search_device), labels.to(search_device)
+
+        T_opt_csece = torch.full((logits.size(1),), init_temp, device=logits.device)
+        scaled_logits = logits / T_opt_csece
+        ece_list.append(ece_criterion(scaled_logits, labels).item())
         if acc_check:
-            _, temp_accuracy, _, _, _ = test_classification_net_logits(class_temperature_scale2(logits, csece_temperature), labels)
+            _, temp_accuracy, _, _, _ = test_classification_net_logits(scaled_logits, labels)
             if temp_accuracy >= accuracy:
                 accuracy = temp_accuracy
 
-        steps_limit = 0.2
-        temp_steps = torch.linspace(-steps_limit, steps_limit, int((2 * steps_limit) / 0.1 + 1))
-        ece_val = 10 ** 7
-        csece_val = 10 ** 7
-        converged = False
-        prev_temperatures = csece_temperature.clone()
+        csece_val = torch.full((1,), 10.0 ** 7, device=logits.device)
+        # The 100 candidates T = 0.1, 0.2, ..., 10 tried for every class
+        temperatures = torch.tensor(temperature_grid(0.1, 0.1, 100), device=logits.device)
         for iter in range(iters):
             print('Started iter ' + str(iter))
         #while not converged:
-            for label in range(logits.size()[1]):
-                #init_temp_value = T_csece[label].item()
-                T = 0.1
-                """
-                nll_val = 10 ** 7
-                ece_val = 10 ** 7
-                csece_val = 10 ** 7
-                """
-                for i in range(100):
-                #for step in temp_steps:
-                    T_csece[label] = T
-                    #T_csece[label] = init_temp_value + step
-                    csece_temperature = T_csece
-                    temperature = T
-                    """
-                    softmaxs = softmax(class_temperature_scale2(logits, csece_temperature))
-                    preds = np.argmax(softmaxs, axis=1)
-                    confs = np.max(softmaxs, axis=1)
-                    after_temperature_ece = ECE(confs, preds, labels, bin_size = 1/num_bins)
-                    """
-                    after_temperature_ece = ece_criterion(class_temperature_scale2(logits, csece_temperature), labels).item()
-                    
-                    if acc_check:
-                        _, temp_accuracy, _, _, _ = test_classification_net_logits(class_temperature_scale2(logits, csece_temperature), labels)
-                    
-                    """
-                    if ece_val > after_temperature_ece_reg:
-                        T_opt_ece = T
-                        ece_val = after_temperature_ece_reg
-                    """
-
+            if jacobi:
+                candidates = temperatures
+                if warm_start and iter > 0:
+                    first = torch.round((T_opt_csece - 0.1) / 0.1).long().sub(5).clamp(0, temperatures.shape[0] - 11)
+                    candidates = temperatures[first.unsqueeze(1) + torch.arange(11, device=logits.device)]
+                class_eces, class_accs = sweep_classes_temperature(
+                    logits, scaled_logits, torch.arange(logits.size(1), device=logits.device), candidates, labels,
+                    ece_criterion.bin_boundaries)
+                if acc_check:
+                    class_eces = class_eces.masked_fill(class_accs.lt(accuracy), float('inf'))
+                best = torch.argmin(class_eces, 1)
+                best_eces = class_eces.gather(1, best.unsqueeze(1)).squeeze(1)
+                best_T = candidates[best] if candidates.dim() == 1 else candidates.gather(1, best.unsqueeze(1)).squeeze(1)
+                improved = best_eces < ece_list[-1]
+                moved = torch.where(improved, best_T, T_opt_csece)
+                # Overshoot check, as in set_temperature_from_logits
+                if scaled_ece(logits, moved, labels, ece_criterion.bin_boundaries).item() >= ece_list[-1]:
+                    improved = improved & torch.arange(logits.size(1), device=logits.device).eq(torch.argmin(best_eces))
+                    moved = torch.where(improved, best_T, T_opt_csece)
+                T_opt_csece.copy_(moved)
+                torch.div(logits, T_opt_csece, out=scaled_logits)
+            elif golden and not acc_check:
+                csece_val = golden_class_temperatures_pass(logits, scaled_logits, T_opt_csece, csece_val, labels,
+                                                           ece_criterion.bin_boundaries)
+            elif not (acc_check or coarse or (warm_start and iter > 0)):
+                csece_val = class_temperatures_pass(logits, scaled_logits, T_opt_csece, csece_val, temperatures,
+                                                    labels, ece_criterion.bin_boundaries, relative=False)
+            else:
+                start_temperatures = T_opt_csece.tolist() if warm_start and iter > 0 else None
+                for label in range(logits.size()[1]):
+                    candidates = temperatures
+                    if start_temperatures is not None:
+                        candidates = temperatures[warm_window(start_temperatures[label], 0.1, 0.1, temperatures.shape[0])]
+                    elif coarse:
+                        coarse_eces, _ = sweep_class_temperature(
+                            logits, scaled_logits, label, temperatures[::10], labels, ece_criterion.bin_boundaries)
+                        candidates = temperatures[coarse_window(coarse_eces.tolist(), 10, temperatures.shape[0])]
+                    candidate_eces, candidate_accs = sweep_class_temperature(
+                        logits, scaled_logits, label, candidates, labels, ece_criterion.bin_boundaries)
                     if acc_check:
-                        if csece_val > after_temperature_ece and temp_accuracy >= accuracy:
-                            T_opt_csece[label] = T
-                            csece_val = after_temperature_ece
-                            accuracy = temp_accuracy
+                        for temp, after_temperature_ece, temp_accuracy in zip(
+                                *torch.stack([candidates, candidate_eces, candidate_accs]).tolist()):
+                            if csece_val > after_temperature_ece and temp_accuracy >= accuracy:
+                                T_opt_csece[label] = temp
+                                csece_val = after_temperature_ece
+                                accuracy = temp_accuracy
                     else:
-                        if csece_val > after_temperature_ece:
-                            #T_opt_csece[label] = init_temp_value + step
-                            T_opt_csece[label] = T
-                            csece_val = after_temperature_ece
-                    T += 0.1
-                T_csece[label] = T_opt_csece[label]
-            csece_temperature = T_opt_csece
-            """
-            softmaxs = softmax(class_temperature_scale2(logits, csece_temperature))
-            preds = np.argmax(softmaxs, axis=1)
-            confs = np.max(softmaxs, axis=1)
-            ece_list.append(ECE(confs, preds, labels, bin_size = 1/num_bins))
-            """
-            ece_list.append(ece_criterion(class_temperature_scale2(logits, csece_temperature), labels).item())
-            #converged = torch.all(csece_temperature.eq(prev_temperatures))
-            #prev_temperatures = csece_temperature.clone()
+                        best = torch.argmin(candidate_eces).view(1)
+                        improved = candidate_eces[best] < csece_val
+                        csece_val = torch.where(improved, candidate_eces[best], csece_val)
+                        T_opt_csece[label:label + 1] = torch.where(improved, candidates[best], T_opt_csece[label:label + 1])
+                    scaled_logits[:, label] = logits[:, label] / T_opt_csece[label]
+            ece_list.append(ece_criterion(scaled_logits, labels).item())
+        T_opt_csece = T_opt_csece.to(device)
         """
         if cross_validate == 'ece':
             temperature = T_opt_ece
@@ -869,7 +1260,7 @@ def bins_temperature_scale2(logits, bece_temperature):
         Perform temperature scaling on logits
         """     
         # Expand temperature to match the size of logits
-        return logits / torch.unsqueeze(bece_temperature, -1)
+        return logits / bece_temperature.view(-1, 1)
 
 
 def histedges_equalN(x, n_bins=15):
@@ -882,197 +1273,133 @@ def histedges_equalN(x, n_bins=15):
 def equal_bins(x, n_bins=15):
     #sorted_samples = np.unique(x.numpy())
     #n, bin_boundaries = np.histogram(x, histedges_equalN(x, n_bins=n_bins))
-    bin_size = int(x.shape[0] / n_bins)
-    sorted_samples = np.sort(x)
-    unique_samples, counts = np.unique(sorted_samples, return_counts=True)
-    many_samples = dict()
-    for sample, count in zip(unique_samples, counts):
-        if count > bin_size:
-            many_samples[sample] = count
+    sorted_samples = np.sort(np.asarray(x))
+    bin_size = int(sorted_samples.shape[0] / n_bins)
+    # The runs of equal samples are read off the sorted samples, np.unique would sort them again
+    run_starts = np.flatnonzero(np.concatenate([[True], sorted_samples[1:] != sorted_samples[:-1]]))
+    unique_samples = sorted_samples[run_starts]
+    counts = np.diff(np.append(run_starts, sorted_samples.shape[0]))
+    many = counts > bin_size
+    many_samples = dict(zip(unique_samples[many], counts[many]))
 
     bin_boundaries = np.zeros(n_bins + 1)
     bin_boundaries[0] = sorted_samples[0]
     #bin_boundaries[-1] = 0.9999999
     bin_boundaries[-1] = 1.0
-    counter = 0
-    i = 1
-    for sample in sorted_samples:
-        if counter == bin_size*i:
-            bin_boundaries[i] = sample
-            i+=1
-        counter+=1
+    # Every bin_size-th sample is an edge, the last one too when bin_size does not divide the samples
+    starts = bin_size * np.arange(1, n_bins + 1) if bin_size > 0 else np.zeros(1, dtype=np.int64)
+    starts = starts[starts < sorted_samples.shape[0]]
+    bin_boundaries[1:starts.shape[0] + 1] = sorted_samples[starts]
 
     return bin_boundaries, many_samples
 
 
-def bin_ece(logits, accuracies, in_bin):
-    accuracies_temp = accuracies[in_bin]
-    origin_accuracy_in_bin = accuracies_temp.float().mean().item()
-    accuracy_in_bin = min(origin_accuracy_in_bin, 0.99)
-    accuracy_in_bin = max(accuracy_in_bin, 0.01)
-    prop_in_bin = in_bin.float().mean()
-    softmaxes_temp = F.softmax(logits, dim=1)
-    confidences_temp, _ = torch.max(softmaxes_temp, 1)
-    avg_confidence_in_bin = confidences_temp.mean()
-    after_temperature = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-    samples = logits.shape[0]
-    ece = (prop_in_bin * after_temperature).item()
-
-    return ece, samples, origin_accuracy_in_bin, avg_confidence_in_bin
+def bins_ece(confidences, accuracies, bin_idx, n_bins):
+    """
+    ECE, number of samples, accuracy and average confidence of every bin from the bin_idx of the samples
+    (n_bins for the samples in no bin). The ECE of a bin clamps its accuracy to [0.01, 0.99].
+    confidences may also be K rows [K, N] of the same samples, then the ECE and average confidence are [K, n_bins]
+    and all rows are binned by one bincount
+    """
+    count = torch.bincount(bin_idx, minlength=n_bins + 1)[:n_bins].float()
+    samples = count.clamp(min=1)
+    accuracy = torch.bincount(bin_idx, weights=accuracies.float(), minlength=n_bins + 1)[:n_bins] / samples
+    if confidences.dim() == 1:
+        avg_confidence = torch.bincount(bin_idx, weights=confidences.float(), minlength=n_bins + 1)[:n_bins] / samples
+    else:
+        k = confidences.shape[0]
+        flat = (bin_idx.unsqueeze(0) + (torch.arange(k, device=bin_idx.device) * (n_bins + 1)).unsqueeze(1)).reshape(-1)
+        conf_sum = torch.bincount(flat, weights=confidences.float().reshape(-1), minlength=k * (n_bins + 1))
+        avg_confidence = conf_sum.view(k, n_bins + 1)[:, :n_bins] / samples
+    ece = torch.abs(accuracy.clamp(0.01, 0.99) - avg_confidence) * count / confidences.shape[-1]
+    return ece, count, accuracy, avg_confidence
 
 
-def bins_temperature_scale_test3(logits, labels, bins_T, iters, bin_boundaries, many_samples, single_temp, best_iter, n_bins=15):
+@inference_mode()
+def bins_temperature_scale_test3(logits, labels, bins_T, iters, bin_boundaries, many_samples, single_temp, best_iter, n_bins=15,
+                                 stats=None):
         """
-        Perform temperature scaling on logits
+        Perform temperature scaling on logits, stats is softmax_stats(logits, labels) when already computed
         """
         ece_criterion = ECELoss(n_bins=25).cuda()
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
-        accuracies = predictions.eq(labels)
+        if stats is None:
+            stats = softmax_stats(logits, labels)
+        softmaxes, _, confidences, predictions, accuracies = stats
         #confidences[confidences > 0.9995] = 0.9995
-        logits_np = logits.cpu().detach().numpy()
-        #logits_max = torch.from_numpy(np.sort(logits_np)[:, -1])
-        #logits_diff = torch.from_numpy((np.sort(logits_np)[:, -1] - np.sort(logits_np)[:, -2]))
-        scaled_logits = logits.clone()
+        origin_confidences = confidences
+        single_confidences = scaled_softmax_max(logits, torch.as_tensor(single_temp))
+        scaled_logits = logits
         ece_list = []
         ece_per_bin = []
         single_ece_per_bin = []
         original_ece_per_bin = []
         print(f'Number of iters: {best_iter + 1}')
+        ones = torch.ones_like(confidences)
         for i in range(best_iter + 1):
-            bin = 0
-            prev_bin = None
-            print('\n')            
-            bin_lowers = bin_boundaries[i][:-1]
-            bin_uppers = bin_boundaries[i][1:]
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-                """
-                if prev_bin == bin_upper:
-                    print('accuracy in bin ', bin + 1, ': ', accuracy_in_bin)
-                    bin += 1
-                    continue
-                if bin_upper in many_samples:
-                    if bin_lower != bin_upper:
-                        in_bin = confidences.gt(bin_lower.item()) * confidences.lt(bin_upper.item())
-                        prop_in_bin = in_bin.float().mean()
-                        avg_confidence_in_bin = confidences[in_bin].mean()
-                        accuracies_temp = accuracies[in_bin]
-                        accuracy_in_bin = accuracies_temp.float().mean().item()
-                        #accuracy_in_bin = min(accuracies_temp.float().mean().item(), 0.99)
-                        #accuracy_in_bin = max(accuracy_in_bin, 0.01)
-                    else:
-                        num_samples = len(confidences[confidences == bin_upper])
-                        bin_size = int(confidences.shape[0] / n_bins)
-                        possible_bins = torch.randint(bin, bin + int(num_samples / bin_size), (num_samples,))
-                        in_bin = torch.zeros(confidences.shape[0], dtype=torch.bool)
-                        in_bin[confidences == bin_upper] = True
-                        prop_in_bin = in_bin.float().mean()
-                        #scaled_logits[in_bin] = scaled_logits[in_bin] / torch.unsqueeze(bins_T[bin, i], -1)
-                        scaled_logits[in_bin] = scaled_logits[in_bin] / torch.unsqueeze(bins_T[possible_bins, i], -1)
-                        softmaxes_temp = F.softmax(scaled_logits[in_bin], dim=1)
-                        confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                        avg_confidence_in_bin = confidences_temp.mean()
-                        accuracies_temp = accuracies[in_bin]
-                        accuracy_in_bin = accuracies_temp.float().mean().item()
-                        #accuracy_in_bin = min(accuracies_temp.float().mean().item(), 0.99)
-                        #accuracy_in_bin = max(accuracy_in_bin, 0.01)
-                        after_temperature = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                        samples = scaled_logits[in_bin].shape[0]
-                        print('ece in bin ', bin + 1, ' :', (prop_in_bin * after_temperature).item(),
-                            ', number of samples: ', samples)
-                        prev_bin = bin_upper
-                        bin += 1
-                        continue
-                else:
-                """
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                if any(in_bin):
-                    """
-                    # Smoothing
-                    bin_len = max(bin_upper - bin_lower, 1e-5)
-                    conf_location = (confidences[in_bin] - bin_lower) / bin_len
-                    high_conf = conf_location.gt(0.5)
-                    low_conf = conf_location.le(0.5)
-                    if bin > 0 and bin < n_bins - 1:
-                        prev_avg = (bins_T[bin, i] + bins_T[bin - 1, i]) / 2
-                        next_avg = (bins_T[bin + 1, i] + bins_T[bin, i]) / 2
-                        temps_high = (2 * (conf_location[high_conf] - 0.5) * abs(bins_T[bin, i] - next_avg) + bins_T[bin, i]).unsqueeze(dim=-1)
-                        temps_low = (2 * conf_location[low_conf] * abs(bins_T[bin, i] - prev_avg) + prev_avg).unsqueeze(dim=-1)
-                    elif bin == 0:
-                        next_avg = (bins_T[bin + 1, i] + bins_T[bin, i]) / 2
-                        temps_high = (2 * (conf_location[high_conf] - 0.5) * abs(bins_T[bin, i] - next_avg) + bins_T[bin, i]).unsqueeze(dim=-1)
-                        temps_low = bins_T[bin, i]
-                    else:
-                        prev_avg = abs(bins_T[bin, i] + bins_T[bin - 1, i]) / 2
-                        temps_high = bins_T[bin, i]
-                        temps_low = (2 * conf_location[low_conf] * abs(bins_T[bin, i] - prev_avg) + prev_avg).unsqueeze(dim=-1)
-                    #temps[temps == 0] = 1e-5
-                    #scaled_logits[in_bin][high_conf] = scaled_logits[in_bin][high_conf] / temps_high
-                    #scaled_logits[in_bin][low_conf] = scaled_logits[in_bin][low_conf] / temps_low
-                    """
-                    original_ece, samples, accuracy_in_bin, origin_avg_confidence_in_bin = bin_ece(logits[in_bin], accuracies, in_bin)
-                    original_ece_per_bin.append(original_ece)
-                    scaled_logits[in_bin] = scaled_logits[in_bin] / bins_T[bin, i]
-                    ece, _, _, _ = bin_ece(scaled_logits[in_bin], accuracies, in_bin)
+            print('\n')
+            boundaries = torch.as_tensor(bin_boundaries[i]).to(device=confidences.device, dtype=confidences.dtype)
+            num_bins = boundaries.shape[0] - 1
+            bin_idx = bin_indices(confidences, boundaries)
+            sample_T = torch.where(bin_idx.lt(num_bins), bins_T[bin_idx.clamp(max=num_bins - 1), i], ones)
+            scaled_logits = logits / sample_T.unsqueeze(1) if i == 0 else scaled_logits.div_(sample_T.unsqueeze(1))
+            scaled_confidences = softmax_max(scaled_logits)
+
+            # ECE of every bin for the original, bins-scaled and single-scaled confidences, and of the iteration
+            eces, count, accuracy, avg_confidences = bins_ece(
+                torch.stack([origin_confidences, scaled_confidences, single_confidences]), accuracies, bin_idx, num_bins)
+            bin_stats = torch.cat([torch.stack([count, accuracy, avg_confidences[0]]), eces])
+            iter_ece = ece_score(scaled_confidences, accuracies, ece_criterion.bin_boundaries)
+            rows = torch.cat([bin_stats, iter_ece.expand(bin_stats.shape[0], 1)], 1).tolist()
+            for bin, (samples, origin_accuracy_in_bin, origin_avg_confidence_in_bin, origin_ece, ece, single) in enumerate(
+                    zip(*(row[:-1] for row in rows))):
+                if samples > 0:
+                    original_ece_per_bin.append(origin_ece)
                     ece_per_bin.append(ece)
-                    single_logits = logits[in_bin] / single_temp
-                    single_ece, _, _, _ = bin_ece(single_logits, accuracies, in_bin)
-                    single_ece_per_bin.append(single_ece)
-                    print('original average confidence in bin ', bin + 1, ' :', origin_avg_confidence_in_bin.item())
+                    single_ece_per_bin.append(single)
+                    print('original average confidence in bin ', bin + 1, ' :', origin_avg_confidence_in_bin)
                     print('ece in bin ', bin + 1, ' :', ece,
-                        ', number of samples: ', samples)
-                    print('accuracy in bin ', bin + 1, ': ', accuracy_in_bin)
-                bin += 1
+                        ', number of samples: ', int(samples))
+                    print('accuracy in bin ', bin + 1, ': ', origin_accuracy_in_bin)
 
-            ece_list.append(ece_criterion(scaled_logits, labels).item())
-            softmaxes = F.softmax(scaled_logits, dim=1)
-            confidences, _ = torch.max(softmaxes, 1)
+            ece_list.append(rows[0][-1])
+            confidences = scaled_confidences
         
         print(ece_list)
                             
         return scaled_logits, ece_per_bin, single_ece_per_bin, original_ece_per_bin, ece_list
 
+@inference_mode()
 def set_temperature3(logits, labels, iters=1, cross_validate='ece',
-                     init_temp=2.5, acc_check=False, const_temp=False, log=True, num_bins=25, top_temp=10):
+                     init_temp=2.5, acc_check=False, const_temp=False, log=True, num_bins=25, top_temp=10, coarse=False,
+                     bisect=False, stats=None, dtype=None, warm_start=False, patience=None):
     """
-    Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL
+    Tune the tempearature of the model (using the validation set) with cross-validation on ECE or NLL.
+    coarse, patience: as in search_temperature. bisect: solve each bin's ECE temperature by bisection.
+    dtype: softmax precision of the single temperature and per-bin ECE sweeps. warm_start: later iterations
+    only try temperatures within 0.5 of init_temp.
+    stats is softmax_stats(logits, labels), computed here when not given
     """
+    if stats is None:
+        stats = softmax_stats(logits, labels)
+    softmaxes, log_softmaxes, confidences, predictions, accuracies = stats
+    probs = (softmaxes, confidences, predictions, accuracies, labels)
     if const_temp:
-        nll_criterion = nn.CrossEntropyLoss().cuda()
         ece_criterion = ECELoss().cuda()
 
         # Calculate NLL and ECE before temperature scaling
-        before_temperature_nll = nll_criterion(logits, labels).item()
-        before_temperature_ece = ece_criterion(logits, labels).item()
+        before_temperature_nll = F.nll_loss(log_softmaxes, labels).item()
+        before_temperature_ece = ece_criterion.forward_from_probs(*probs).item()
         if log:
             print('Before temperature - NLL: %.3f, ECE: %.3f' % (before_temperature_nll, before_temperature_ece))
 
-        nll_val = 10 ** 7
-        ece_val = 10 ** 7
-        T_opt_nll = 1.0
-        T_opt_ece = 1.0
-        T = 0.1
-        for i in range(100):
-            temperature = T
-            after_temperature_nll = nll_criterion(temperature_scale2(logits, temperature), labels).item()
-            after_temperature_ece = ece_criterion(temperature_scale2(logits, temperature), labels).item()
-            if nll_val > after_temperature_nll:
-                T_opt_nll = T
-                nll_val = after_temperature_nll
-
-            if ece_val > after_temperature_ece:
-                T_opt_ece = T
-                ece_val = after_temperature_ece
-            T += 0.1
-
-        if cross_validate == 'ece':
-            temperature = T_opt_ece
-        else:
-            temperature = T_opt_nll
+        # All 100 candidates T = 0.1, 0.2, ..., 10 in one batched sweep
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        temperature = search_temperature(logits, labels, temperatures, ece_criterion.bin_boundaries,
+                                         cross_validate=cross_validate, coarse=coarse, dtype=dtype, patience=patience)
 
         # Calculate NLL and ECE after temperature scaling
-        after_temperature_nll = nll_criterion(temperature_scale2(logits, temperature), labels).item()
-        after_temperature_ece = ece_criterion(temperature_scale2(logits, temperature), labels).item()
+        after_temperature_nll, after_temperature_ece = torch.cat(
+            nll_ece(temperature_scale2(logits, temperature), labels, ece_criterion.bin_boundaries)).tolist()
         if log:
             print('Optimal temperature: %.3f' % temperature)
             print('After temperature - NLL: %.3f, ECE: %.3f' % (after_temperature_nll, after_temperature_ece))
@@ -1083,8 +1410,7 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
         """
         # Calculate ECE before temperature scaling
         ece_criterion = ECELoss(n_bins=num_bins).cuda()
-        nll_criterion = nn.CrossEntropyLoss().cuda()
-        before_temperature_ece = ece_criterion(logits, labels).item()
+        before_temperature_ece = ece_criterion.forward_from_probs(*probs).item()
         if log:
             print('Before temperature - ECE: %.3f' % (before_temperature_ece))
             
@@ -1092,32 +1418,36 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
         if cross_validate != 'ece':
             n_bins = 50
         eps = 1e-5
-        nll_val = 10 ** 7
-        ece_val = 10 ** 7
         T_opt_nll = 1.0
         T_opt_ece = 1.0
-        T = 0.1
-        labels = labels.type(torch.LongTensor).cuda()
-        temps_iters = torch.ones(iters).cuda()
+        labels = labels.long()
+        temps_iters = torch.ones(iters, device=logits.device)
+        # Each iteration continues the grid with the running best kept, so it takes the best of its prefix
+        temperatures = temperature_grid(0.1, 0.1, 100 * iters)
+        if not coarse:
+            grid_ece, grid_nll = sweep_temperatures(
+                logits, labels, torch.tensor(temperatures, device=logits.device), ece_criterion.bin_boundaries, dtype=dtype)
+            # The best of every iteration's prefix of the grid
+            prefix_best = torch.stack([torch.stack([torch.argmin(grid_ece[:100 * (i + 1)]), torch.argmin(grid_nll[:100 * (i + 1)])])
+                                       for i in range(iters)]).tolist()
+        iter_eces = []
         for i in range(iters):
-            temp_logits = logits.clone()
-            for t in range(100):
-                temperature = T
-                after_temperature_ece = ece_criterion(temperature_scale2(temp_logits, temperature), labels).item()
-                after_temperature_nll = nll_criterion(temperature_scale2(temp_logits, temperature), labels).item()
-                if ece_val > after_temperature_ece:
-                    T_opt_ece = T
-                    ece_val = after_temperature_ece
-                if nll_val > after_temperature_nll:
-                    T_opt_nll = T
-                    nll_val = after_temperature_nll
-                T += 0.1
+            if coarse:
+                T_opt_ece = search_temperature(logits, labels, temperatures[:100 * (i + 1)], ece_criterion.bin_boundaries,
+                                               coarse=True, dtype=dtype)
+                if cross_validate != 'ece':
+                    T_opt_nll = search_temperature(logits, labels, temperatures[:100 * (i + 1)], ece_criterion.bin_boundaries,
+                                                   cross_validate=cross_validate, coarse=True, dtype=dtype)
+            else:
+                T_opt_ece = temperatures[prefix_best[i][0]]
+                T_opt_nll = temperatures[prefix_best[i][1]]
             if cross_validate == 'ece':
                 temps_iters[i] = T_opt_ece
             else:
                 temps_iters[i] = T_opt_nll
-            temp_logits = temp_logits / T_opt_ece
-            after_temperature_ece = ece_criterion(temperature_scale2(temp_logits, T_opt_ece), labels).item()
+            temp_logits = logits / T_opt_ece
+            iter_eces.append(ece_criterion(temperature_scale2(temp_logits, T_opt_ece), labels))
+        for i, after_temperature_ece in enumerate(torch.cat(iter_eces).tolist()):
             print('Temperature for #{} iteration for single TS: {}'.format(i + 1, after_temperature_ece))
             
         if cross_validate == 'ece':
@@ -1133,59 +1463,53 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
             print('Optimal temperature: %.3f' % init_temp)
             print('After temperature - ECE: %.3f' % (after_temperature_ece))
 
-        init_temp = 1
+        init_temp = 1.0
         #top_temp = T_opt_ece
         
-        bins_T = init_temp*torch.ones((n_bins, iters)).cuda()
+        bins_T = torch.full((n_bins, iters), init_temp, device=logits.device)
         ece_list = []        
-        ece_list.append(ece_criterion(temperature_scale2(logits, temperature), labels).item())
+        ece_list.append(after_temperature_ece)
                 
-        softmaxes = F.softmax(logits, dim=1)
-        confidences, predictions = torch.max(softmaxes, 1)
         #confidences[confidences > 0.9995] = 0.9995
-        accuracies = predictions.eq(labels)
         
-        bin_boundaries = torch.linspace(0, 1, n_bins + 1).unsqueeze(0).repeat((iters, 1)).numpy()
+        bin_boundaries = torch.linspace(0, 1, n_bins + 1).unsqueeze(0).repeat((iters, 1)).cuda()
         
         #steps_limit = 0.2
         #temp_steps = torch.linspace(-steps_limit, steps_limit, int((2 * steps_limit) / 0.1 + 1)).cuda()
         many_samples = None
-        original_bins = torch.zeros(confidences.shape)
+        original_bins = torch.zeros(confidences.shape, dtype=torch.long, device=confidences.device)
+        zero_bins = torch.zeros(confidences.shape, dtype=torch.long, device=confidences.device)
         ece_ada_list = []
-        count_high_acc = 0
         is_acc = False
-        n, bin_boundaries[0] = np.histogram(confidences.cpu().detach(), histedges_equalN(confidences.cpu().detach(), n_bins=n_bins))
-        bin_lowers = bin_boundaries[0][:-1]
-        bin_uppers = bin_boundaries[0][1:]
-        
-        for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-            in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-            if any(in_bin):
-                accuracies_temp = accuracies[in_bin]
-                origin_accuracy_in_bin = accuracies_temp.float().mean().item()
-                if origin_accuracy_in_bin > 0.99:
-                    count_high_acc += 1
+        bin_boundaries[0] = equal_mass_bin_edges(confidences, n_bins)
+        # Accuracy of every (lower, upper] bin from one bucketize, empty bins give nan
+        in_range = confidences.gt(bin_boundaries[0][0]) & confidences.le(bin_boundaries[0][-1])
+        bin_idx = torch.bucketize(confidences[in_range], bin_boundaries[0][1:-1])
+        count = torch.bincount(bin_idx, minlength=n_bins).float()
+        acc_sum = torch.bincount(bin_idx, weights=accuracies[in_range].float(), minlength=n_bins).float()
+        count_high_acc = (acc_sum / count).gt(0.99).sum().item()
         if count_high_acc > int(n_bins/2):  # model is highly accurated
             is_acc = True
-            confidences[confidences > 0.9995] = 0.9995
-
+            # Not in place, the confidences may be the caller's stats
+            confidences = confidences.clamp(max=0.9995)
+
+        # Bins of the current confidences, computed again only after the logits are rescaled
+        binning = None
+        temperatures = temperature_grid(0.1, 0.1, 100)
+        bin_temperatures = torch.tensor(temperatures, device=logits.device)
+        # The sample temperatures of an iteration, as a column
+        if cross_validate == 'ece':
+            T_opt_bece = torch.empty(logits.shape[0], 1, device=logits.device)
+        else:
+            T_opt_nll = torch.empty(logits.shape[0], 1, device=logits.device)
         for i in range(iters):
-            if cross_validate == 'ece':
-                T_opt_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-                T_bece = init_temp*torch.ones(logits.shape[0]).cuda()
-                bece_temperature = T_bece
-            else:
-                T_opt_nll = init_temp*torch.ones(logits.shape[0]).cuda()
-                T_nll = init_temp*torch.ones(logits.shape[0]).cuda()
-                nll_temperature = T_nll
-            
             ece_in_iter = 0
             print('iter num ', i+1)
             bin = 0
             few_examples = dict()
             starts = dict()
             if i == 0:
-                n, bin_boundaries[i] = np.histogram(confidences.cpu().detach(), histedges_equalN(confidences.cpu().detach(), n_bins=n_bins))
+                bin_boundaries[i] = equal_mass_bin_edges(confidences, n_bins)
                 """
                 high_bins = (torch.Tensor(bin_boundaries[i]) > 0.999).nonzero(as_tuple=True)[0]
                 bounds = [0.999, 0.9999, 0.99999]
@@ -1201,149 +1525,111 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
             
             #bin_boundaries = torch.linspace(0, 1, n_bins + 1)
             #bin_boundaries[i], many_samples = equal_bins(confidences.cpu().detach(), n_bins=n_bins)
-            bin_lowers = bin_boundaries[i][:-1]
-            bin_uppers = bin_boundaries[i][1:]
-
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-                """
-                if bin_upper in many_samples:
-                    in_bin = torch.zeros(confidences.shape[0], dtype=torch.bool)
-                    if bin_upper in starts:
-                        start_point = starts[bin_upper]
-                        if int(confidences.shape[0] / n_bins) >= many_samples[bin_upper] - starts[bin_upper]:
-                            end_point = start_point + many_samples[bin_upper] - starts[bin_upper]
-                            del starts[bin_upper]
-                        else:
-                            end_point = start_point + int(confidences.shape[0] / n_bins)
-                        starts[bin_upper] = end_point
-                        #in_bin = sorted_confidences[start_point:end_point]
-                        in_bin[indices[start_point:end_point]] = True
-                    else:
-                        confidences_range = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                        sorted_confidences, indices = torch.sort(confidences[confidences_range])
-                        diff = len(confidences[confidences_range]) - len(confidences[confidences_range][confidences[confidences_range]==bin_upper])
-                        #in_bin = sorted_confidences[:int(confidences.shape[0] / n_bins)]
-                        in_bin[indices[:int(confidences.shape[0] / n_bins)]] = True
-                        starts[bin_upper] = int(confidences.shape[0] / n_bins) - diff
-                    
+            if binning is None:
+                binning = bin_order(confidences, bin_boundaries[i])
+                counts = binning[2].tolist()
+            bin_idx, order = binning[:2]
+            iter_temperatures, iter_bin_temperatures = temperatures, bin_temperatures
+            bisect_range = (0.1, 10.0)
+            if warm_start and i > 0:
+                window = warm_window(init_temp, 0.1, 0.1, len(temperatures))
+                iter_temperatures, iter_bin_temperatures = temperatures[window], bin_temperatures[window]
+                bisect_range = (iter_temperatures[0], iter_temperatures[-1])
+
+            # The statistics, grid sweeps and bisections of all bins from passes over all the samples
+            bin_count = binning[2].float()
+            origin_accuracies = torch.bincount(bin_idx, weights=accuracies.float(), minlength=n_bins + 1)[:n_bins] / bin_count
+            origin_confidences = torch.bincount(bin_idx, weights=confidences, minlength=n_bins + 1)[:n_bins] / bin_count
+            if is_acc and cross_validate == 'ece':
+                bin_accuracies = origin_accuracies
+            else:
+                bin_accuracies = torch.clamp(origin_accuracies, 0.01, 0.99)
+            searched = [bin for bin, samples in enumerate(counts)
+                        if samples > 0 and not (samples < 20 and cross_validate == 'ece')]
+            is_searched = torch.zeros(n_bins + 1, dtype=torch.bool, device=logits.device)
+            is_searched[searched] = True
+            # The sweeps skip the samples of the few-example and out-of-range bins
+            sweep_logits, sweep_labels, sweep_bin_idx = logits, labels, bin_idx
+            if sum(counts[bin] for bin in searched) < logits.shape[0]:
+                swept = is_searched[bin_idx]
+                sweep_logits, sweep_labels, sweep_bin_idx = logits[swept], labels[swept], bin_idx[swept]
+            candidates = [iter_temperatures] * n_bins
+            if cross_validate != 'ece':
+                # Every bin starts from init_temp, so its starting NLL is the last column of the same sweep
+                grid_vals = bins_temperature_nlls(sweep_logits, sweep_labels, sweep_bin_idx, n_bins,
+                                                  torch.cat([iter_bin_temperatures, bins_T[:1, i]]))
+                start_vals, after_temperatures, after_temperatures_eps = grid_vals[:, -1], grid_vals[:, :-1], grid_vals[:, :-1]
+            else:
+                start_vals = torch.abs(bin_accuracies - origin_confidences)
+                if bisect:
+                    solved, solved_confidences = solve_bins_temperature(sweep_logits, bin_accuracies, sweep_bin_idx,
+                                                                        n_bins, *bisect_range, dtype=dtype)
+                    candidates = [[T] for T in solved.tolist()]
+                    after_temperatures = torch.abs(bin_accuracies - solved_confidences).unsqueeze(1)
                 else:
-                """
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                prop_in_bin = in_bin.float().mean()
-                if confidences[in_bin].shape[0] < 20 and cross_validate == 'ece':
-                    samples = T_bece[in_bin].shape[0]
+                    after_temperatures = torch.abs(bin_accuracies.unsqueeze(1) - bins_mean_confidences(
+                        sweep_logits, sweep_bin_idx, n_bins, iter_bin_temperatures, dtype=dtype))
+                after_temperatures_eps = after_temperatures + eps
+            bin_stats = torch.cat([torch.stack([origin_accuracies, origin_confidences, start_vals], 1),
+                                   after_temperatures, after_temperatures_eps], 1).tolist()
+
+            # The column of the iteration has not been written yet, so every bin starts from init_temp
+            iter_bins_T = [init_temp] * n_bins
+            for bin, samples in enumerate(counts):
+                if samples < 20 and cross_validate == 'ece':
                     print('number of samples in bin {0}: {1}'.format(bin + 1, samples))
                     few_examples[bin] = samples
-                    bin += 1
                     continue
-                if any(in_bin):
-                    #init_temp_value = T_bece[in_bin][0].item()
-                    T = 0.1
-                    accuracies_temp = accuracies[in_bin]
-                    origin_accuracy_in_bin = accuracies_temp.float().mean().item()
-                    origin_avg_confidence_in_bin = confidences[in_bin].mean()
-                    accuracy_in_bin = min(origin_accuracy_in_bin, 0.99)
-                    accuracy_in_bin = max(accuracy_in_bin, 0.01)
-                    
-                    if is_acc and cross_validate == 'ece':
-                        accuracy_in_bin = origin_accuracy_in_bin
-                        
-                    if cross_validate == 'ece':
-                        bece_val = torch.abs(accuracy_in_bin - origin_avg_confidence_in_bin)
-                    else:
-                        nll_val = nll_criterion(logits[in_bin] / bins_T[bin, i], labels[in_bin]).item()
-                    for t in range(100):
-                    #for step in temp_steps:
-                        #T_bece[in_bin] = init_temp_value + step
-                        """
-                        if accuracy_in_bin == 0:
-                            T_opt_bece[in_bin] = top_temp
-                            softmaxes_temp = F.softmax(logits[in_bin] / top_temp, dim=1)
-                            confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                            avg_confidence_in_bin = confidences_temp.mean()
-                            bece_val = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                            break
-                        """
-                        
-                        if cross_validate == 'ece':
-                            T_bece[in_bin] = T
-                            bece_temperature = T_bece
-                            softmaxes_temp = F.softmax(logits[in_bin] / torch.unsqueeze(T_bece[in_bin], -1), dim=1)
-                            confidences_temp, _ = torch.max(softmaxes_temp, 1)
-                            avg_confidence_in_bin = confidences_temp.mean()
-                            after_temperature = torch.abs(accuracy_in_bin - avg_confidence_in_bin)
-                            
-                            if bece_val > after_temperature + eps:
-                                #T_opt_bece[in_bin] = init_temp_value + step
-                                T_opt_bece[in_bin] = T
-                                bece_val = after_temperature                      
-                        
-                        else:
-                            T_nll[in_bin] = T
-                            nll_temperature = T_nll
-                            after_temperature_nll = nll_criterion(logits[in_bin] / torch.unsqueeze(T_nll[in_bin], -1), labels[in_bin]).item() 
-                            
-                            if nll_val > after_temperature_nll:
-                                T_opt_nll[in_bin] = T
-                                nll_val = after_temperature_nll
-                        
-                        T += 0.1
-                      
-                    original_bins[in_bin] = bin
-                    if cross_validate == 'ece':
-                        T_bece[in_bin] = T_opt_bece[in_bin]
-                        bins_T[bin, i] = T_opt_bece[in_bin][0].item()
-                        samples = T_bece[in_bin].shape[0]
-                        ece_in_iter += prop_in_bin * bece_val
-                    else:
-                        T_nll[in_bin] = T_opt_nll[in_bin]
-                        bins_T[bin, i] = T_opt_nll[in_bin][0].item()
-                        samples = T_nll[in_bin].shape[0]
-                        ece_in_iter += prop_in_bin * nll_val
-                                            
-                    print('original average confidence in bin ', bin + 1, ' :', origin_avg_confidence_in_bin.item())
-                    if cross_validate == 'ece':
-                        print('ece in bin ', bin+1, ' :', (prop_in_bin * bece_val).item(), ', number of samples: ', samples)
-                    else:
-                        print('ece in bin ', bin+1, ' :', (prop_in_bin * nll_val).item(), ', number of samples: ', samples)
-                    print('accuracy in bin ', bin+1, ': ', origin_accuracy_in_bin)
-
-                bin += 1
-
-            print(bins_T[:, i])
+                if samples == 0:
+                    continue
+                n_candidates = len(candidates[bin])
+                origin_accuracy_in_bin, origin_avg_confidence_in_bin, bin_val = bin_stats[bin][:3]
+                bin_after_temperatures = bin_stats[bin][3:3 + n_candidates]
+                bin_after_temperatures_eps = bin_stats[bin][3 + n_candidates:3 + 2 * n_candidates]
+                # The same strict-improvement scan over the candidates, on the host values
+                bin_T = init_temp
+                for T, after_temperature, after_temperature_eps in zip(candidates[bin], bin_after_temperatures,
+                                                                       bin_after_temperatures_eps):
+                    if bin_val > after_temperature_eps:
+                        bin_T = T
+                        bin_val = after_temperature
+                iter_bins_T[bin] = bin_T
+                prop_in_bin = samples / confidences.shape[0]
+                ece_in_iter += prop_in_bin * bin_val
+
+                print('original average confidence in bin ', bin + 1, ' :', origin_avg_confidence_in_bin)
+                print('ece in bin ', bin+1, ' :', prop_in_bin * bin_val, ', number of samples: ', samples)
+                print('accuracy in bin ', bin+1, ': ', origin_accuracy_in_bin)
+
+            # The searched bins' temperatures, written to their samples and to bins_T at once
+            iter_bins_T = torch.tensor(iter_bins_T + [init_temp], device=logits.device)
             if cross_validate == 'ece':
-                for bin in few_examples:
-                    #bins_T[bin, i] = temperature
-
-                    if bin > 0 and bin < n_bins - 1:
-                        lower_bin = bin - 1
-                        upper_bin = bin + 1
-                        while lower_bin in few_examples and lower_bin - 1 >= 0:
-                            lower_bin -= 1
-                        while upper_bin in few_examples and upper_bin + 1 <= n_bins - 1:
-                            upper_bin += 1
-                        if upper_bin == n_bins - 1:
-                            bins_T[bin, i] = bins_T[lower_bin, i]
-                        else:
-                            avg_temp = (bins_T[lower_bin, i] + bins_T[upper_bin, i]) / 2  # Mean temperature of neighbors
-                            bins_T[bin, i] = avg_temp
-                    elif bin == 0:
-                        upper_bin = bin + 1
-                        while upper_bin in few_examples and upper_bin + 1 <= n_bins - 1:
-                            upper_bin += 1
-                        bins_T[bin, i] = bins_T[upper_bin, i]
-                    else:
-                        lower_bin = bin - 1
-                        while lower_bin in few_examples and lower_bin - 1 >= 0:
-                            lower_bin -= 1
-                        bins_T[bin, i] = bins_T[lower_bin, i]
+                T_opt_bece.copy_(iter_bins_T[bin_idx].view(-1, 1))
+            else:
+                T_opt_nll.copy_(iter_bins_T[bin_idx].view(-1, 1))
+            bins_T[:, i] = iter_bins_T[:n_bins]
+            original_bins = torch.where(is_searched[bin_idx], bin_idx, original_bins)
+            print(bins_T[:, i])
+            if cross_validate == 'ece' and few_examples:
+                # The nearest valid neighbours of all the few-example bins at once
+                bins_T[:, i] = fill_few_bins(bins_T[:, i], list(few_examples))
             
+            # Rescaled in place after the first iteration, whose logits may be the caller's
             if cross_validate == 'ece':
-                bece_temperature = T_opt_bece
-                current_ece = ece_criterion(bins_temperature_scale2(logits, bece_temperature), labels).item()
+                sample_temperatures = T_opt_bece
+            else:
+                sample_temperatures = T_opt_nll
+            if i == 0:
+                logits = logits / sample_temperatures
             else:
-                nll_temperature = T_opt_nll
-                current_ece = ece_criterion(bins_temperature_scale2(logits, nll_temperature), labels).item()
+                logits.div_(sample_temperatures)
+            scaled_confidences = softmax_max(logits)
+            # The next iteration keeps these edges, so its bins are the ones the samples moved to
+            binning = bin_order(scaled_confidences, bin_boundaries[i])
+            moved_bins = torch.where(binning[0].lt(n_bins), binning[0], zero_bins)
+            iter_stats = torch.cat([ece_score(scaled_confidences, accuracies, ece_criterion.bin_boundaries),
+                                    torch.eq(original_bins, moved_bins).sum().view(1).float(), binning[2].float()]).tolist()
+            current_ece, unmoved, counts = iter_stats[0], int(iter_stats[1]), [int(c) for c in iter_stats[2:]]
             print('ece in iter ', i+1, ' :', current_ece)
             if i > 0 and current_ece < ece_list[best_iter]:
                 best_iter = i
@@ -1355,22 +1641,9 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
                 iters = i + 1
                 break
 
-            ece_ada_list.append(ece_in_iter.item())
-            if cross_validate == 'ece':
-                logits = logits / torch.unsqueeze(bece_temperature, -1)
-            else:
-                logits = logits / torch.unsqueeze(nll_temperature, -1)
-            softmaxes = F.softmax(logits, dim=1)
-            confidences, _ = torch.max(softmaxes, 1)
-            moved_bins = torch.zeros(confidences.shape)
-            bin = 0
-            for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-                in_bin = confidences.gt(bin_lower.item()) * confidences.le(bin_upper.item())
-                moved_bins[in_bin] = bin
-                bin += 1
-            bins_moved = torch.eq(original_bins, moved_bins)
-            moved_precentage = bins_moved.float().mean()
-            print('Precentage of moved bins after scaling: ', 100 - (moved_precentage * 100).item())
+            ece_ada_list.append(ece_in_iter)
+            confidences = scaled_confidences
+            print('Precentage of moved bins after scaling: ', 100 - unmoved * 100 / confidences.shape[0])
         
         if const_temp:
             return temperature
@@ -1378,11 +1651,9 @@ def set_temperature3(logits, labels, iters=1, cross_validate='ece',
             return bins_T, temperature, bin_boundaries, many_samples, best_iter
 
 def check_movements(logits, const):
-    softmaxes = F.softmax(logits, dim=1)
-    original_confidences, _ = torch.max(softmaxes, 1)
-    before_indices = torch.argsort(original_confidences)
-    moved_softmaxes = F.softmax(logits / const, dim=1)
-    moved_confidences, _ = torch.max(moved_softmaxes, 1)
-    after_indices = torch.argsort(moved_confidences)
+    original_confidences = softmax_max(logits)
+    moved_confidences = scaled_softmax_max(logits, torch.as_tensor(const))
+    # Both orders from one sort of the two rows
+    before_indices, after_indices = torch.argsort(torch.stack([original_confidences, moved_confidences]), dim=1)
     
     return before_indices, after_indices
\ No newline at end of file